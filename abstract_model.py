@@ -24,6 +24,7 @@ import os.path
 import csv
 import ast
 import traceback
+import concurrent.futures
 from io import StringIO
 
 from qgis.core import (
@@ -32,6 +33,7 @@ from qgis.core import (
     QgsProject,
     QgsCoordinateTransform,
     QgsProcessingUtils,
+    QgsProcessingContext,
     QgsProcessingFeedback,
     NULL)
 
@@ -558,6 +560,9 @@ class AbstractGroupModel(QAbstractTableModel):
 # DictModel is a group model with dictionary items
 class DictModel(AbstractGroupModel):
 
+    # Number of items applied concurrently by applyItemsWithContext
+    nb_workers = 1
+
     def __init__(self,itemClass=None,fields=[],
             feedback=None,display_fields=None):
         if not itemClass:
@@ -768,18 +773,81 @@ class DictModel(AbstractGroupModel):
                 writer.writerow(i.dict)
         feedbacks.debug("Model saved to file '" + str(fname) + "'")
 
-    def applyItemsWithContext(self,context,feedback,indexes=None):
+    # Returns input paths of item, used to schedule items of several models
+    # (see MainModel.applyModelsDAG). To be redefined in models.
+    def getItemInPaths(self,item):
+        return []
+
+    # Returns output paths of item (see getItemInPaths)
+    def getItemOutPaths(self,item):
+        if hasattr(self,"getItemOutPath"):
+            return [self.getItemOutPath(item)]
+        return []
+
+    # Applies items of given indexes (all items if None) and returns results
+    # of applyItemWithContext in indexes order. If 'nb_workers' (default to
+    # self.nb_workers) is greater than 1, items are applied concurrently
+    # (see applyItemsConcurrently) and must thus be independent.
+    def applyItemsWithContext(self,context,feedback,indexes=None,nb_workers=None):
         if not self.items:
             self.feedback.reportError("Empty Model")
         if not indexes:
             indexes = range(0,len(self.items))
+        indexes = list(indexes)
+        nb_workers = self.nb_workers if nb_workers is None else nb_workers
+        if nb_workers > 1 and len(indexes) > 1:
+            return self.applyItemsConcurrently(context,feedback,indexes,nb_workers)
         nb_steps = len(indexes)
         step_feedback = feedbacks.ProgressMultiStepFeedback(nb_steps,feedback)
         step_feedback.setCurrentStep(0)
+        results = []
         for cpt, n in enumerate(indexes,1):
             i = self.items[n]
-            self.applyItemWithContext(i,context,step_feedback)
+            results.append(self.applyItemWithContext(i,context,step_feedback))
             step_feedback.setCurrentStep(cpt)
+        return results
+
+    # Applies items in a pool of 'nb_workers' threads. Each item is applied
+    # with its own QgsProcessingContext (sharing project of 'context') and
+    # its own BufferedFeedback whose messages are forwarded to 'feedback'
+    # in indexes order. Progress is the mean of items progress.
+    # If an item fails, pending items are canceled and error is raised.
+    def applyItemsConcurrently(self,context,feedback,indexes,nb_workers):
+        project = context.project() if context else QgsProject.instance()
+        item_feedbacks = [ feedbacks.BufferedFeedback() for n in indexes ]
+        def applyItem(n,item_feedback):
+            item_context = QgsProcessingContext()
+            item_context.setProject(project)
+            item_context.setFeedback(item_feedback)
+            return self.applyItemWithContext(self.items[n],item_context,item_feedback)
+        feedback.pushInfo("Applying " + str(len(indexes)) + " items with "
+            + str(nb_workers) + " workers")
+        results = [None] * len(indexes)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            futures = [ executor.submit(applyItem,n,f)
+                for n, f in zip(indexes,item_feedbacks) ]
+            next_idx = 0
+            try:
+                while next_idx < len(futures):
+                    concurrent.futures.wait(futures[next_idx:],timeout=0.1,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    if feedback.isCanceled():
+                        for f in item_feedbacks:
+                            f.cancel()
+                    # Results and logs are forwarded in indexes order
+                    while next_idx < len(futures) and futures[next_idx].done():
+                        item_feedbacks[next_idx].replay(feedback)
+                        results[next_idx] = futures[next_idx].result()
+                        next_idx += 1
+                    feedback.setProgress(sum(100 if future.done() else f.progress()
+                        for future, f in zip(futures,item_feedbacks)) / len(futures))
+                    QCoreApplication.processEvents()
+            except Exception:
+                for future, f in zip(futures,item_feedbacks):
+                    future.cancel()
+                    f.cancel()
+                raise
+        return results
 
 
 class NormalizingParamsModel(QAbstractTableModel):
@@ -1556,6 +1624,63 @@ class MainModel:
         feedbacks.debug("getOutLayerFromName abs_layer " + str(abs_layer))
         return abs_layer
 
+    # Applies items of 'models' (default to self.models) in dependency order,
+    # an item depending on another one if it consumes its outputs (see
+    # DictModel.getItemInPaths and getItemOutPaths). Independent items are
+    # applied concurrently with 'nb_workers' threads. Items whose outputs are
+    # newer than their inputs and whose values did not change since their
+    # last run are skipped unless 'force' is True. Items of models not
+    # declaring inputs (getItemInPaths) are always applied.
+    # Reports tasks status and critical path timing, returns scheduler.
+    def applyModelsDAG(self,feedback,models=None,nb_workers=1,force=False):
+        models = self.models if models is None else models
+        item_feedbacks = {}
+        params_model = getattr(self,"paramsModel",None)
+        workspace = getattr(params_model,"workspace",None)
+        state_path = os.path.join(workspace,".dag_state.json") if workspace else None
+        scheduler = utils.DAGScheduler(nb_workers=nb_workers,force=force,
+            cancel_func=feedback.isCanceled,state_path=state_path)
+        def mkFunc(model,item,item_feedback):
+            def applyItem():
+                context = QgsProcessingContext()
+                context.setProject(QgsProject.instance())
+                context.setFeedback(item_feedback)
+                return model.applyItemWithContext(item,context,item_feedback)
+            return applyItem
+        for model in models:
+            for item in model.items:
+                name = model.__class__.__name__ + ":" + str(item.getName())
+                item_feedbacks[name] = feedbacks.BufferedFeedback()
+                scheduler.addTask(name,mkFunc(model,item,item_feedbacks[name]),
+                    inputs=[ self.getOrigPath(p) for p in model.getItemInPaths(item) if p ],
+                    outputs=[ self.getOrigPath(p) for p in model.getItemOutPaths(item) if p ],
+                    params=item.dict)
+        nb_tasks = len(scheduler.tasks)
+        if nb_tasks == 0:
+            feedback.pushWarning("No item to apply")
+            return scheduler
+        def endTask(task):
+            item_feedbacks[task.name].replay(feedback)
+            feedback.pushInfo("Item '" + task.name + "' " + str(task.status)
+                + (" in " + str(task.duration()) + " seconds" if task.status == 'done' else ""))
+            nb_ended = len([ t for t in scheduler.tasks.values() if t.status ])
+            feedback.setProgress(100 * nb_ended / nb_tasks)
+        def wait():
+            if feedback.isCanceled():
+                for f in item_feedbacks.values():
+                    f.cancel()
+            QCoreApplication.processEvents()
+        scheduler.end_func = endTask
+        scheduler.wait_func = wait
+        try:
+            scheduler.run()
+        finally:
+            path, path_time = scheduler.criticalPath()
+            feedback.pushInfo("Model applied in " + str(scheduler.wall_time)
+                + " seconds, critical path (" + str(path_time) + " seconds) : "
+                + " -> ".join(t.name + " (" + str(t.duration()) + "s)" for t in path))
+        return scheduler
+
     # def fromXMLRoot(self,root):
         # for child in root:
             # feedbacks.debug("tag = " + str(child.tag))
@@ -25,6 +25,7 @@
 
 import time
 import datetime
+import threading
 
 from qgis.core import (QgsProcessingFeedback,
     QgsProcessingMultiStepFeedback,
@@ -340,3 +341,83 @@ class FileFeedback(QgsProcessingFeedback):
         pass
 
 
+# Feedback recording messages to forward them later to another feedback,
+# e.g. from a worker thread to GUI feedback in a deterministic order.
+# Progress is stored (see progress()) and cancellation is driven by caller.
+class BufferedFeedback(QgsProcessingFeedback):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.lock = threading.Lock()
+        self.sectionText = ""
+        self.sectionHeader = "********"
+
+    def record(self,method,*args):
+        with self.lock:
+            self.records.append((method,args))
+
+    def pushCommandInfo(self,msg):
+        self.record("pushCommandInfo",msg)
+
+    def pushConsoleInfo(self,msg):
+        self.record("pushConsoleInfo",msg)
+
+    def pushDebugInfo(self,msg):
+        self.record("pushDebugInfo",msg)
+
+    def pushInfo(self,msg):
+        self.record("pushInfo",msg)
+
+    def pushWarning(self,msg):
+        self.record("pushWarning",msg)
+
+    def reportError(self,error,fatalError=False):
+        self.record("reportError",error,fatalError)
+
+    def error_msg(self,msg,prefix=""):
+        self.record("error_msg",msg,prefix)
+
+    def user_error(self,msg,fatal=True):
+        self.error_msg(msg,"user error")
+        if fatal:
+            raise utils.CustomException(msg)
+
+    def internal_error(self,msg,fatal=True):
+        self.error_msg(msg,"internal error")
+        if fatal:
+            raise utils.CustomException(msg)
+
+    def todo_error(self,msg,fatal=True):
+        self.error_msg(msg,"Feature not yet implemented")
+        if fatal:
+            raise utils.CustomException(msg)
+
+    def beginSection(self,txt):
+        self.sectionText = txt
+        self.start_time = time.time()
+        self.pushInfo(self.sectionHeader + " BEGIN : " + txt)
+
+    def endSection(self):
+        diff_time = time.time() - self.start_time
+        self.pushInfo(self.sectionHeader + " END : " + self.sectionText + " in " + str(diff_time) + " seconds")
+        self.sectionText = ""
+
+    def setProgressText(self,text):
+        pass
+
+    def setSubText(self,text):
+        pass
+
+    def endJob(self):
+        pass
+
+    # Forwards recorded messages to 'feedback' and clears them
+    def replay(self,feedback):
+        with self.lock:
+            records, self.records = self.records, []
+        for method, args in records:
+            if method == "error_msg" and not hasattr(feedback,"error_msg"):
+                feedback.pushWarning("[" + args[1] + "] " + args[0])
+            else:
+                getattr(feedback,method)(*args)
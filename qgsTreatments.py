@@ -24,6 +24,8 @@
 """
 
 from qgis.core import (Qgis,
+                       QgsApplication,
+                       QgsMapLayer,
                        QgsProcessing,
                        QgsProcessingFeedback,
                        QgsProcessingAlgorithm,
@@ -33,24 +35,47 @@ from qgis.core import (Qgis,
                        QgsFeature,
                        QgsFeatureRequest,
                        QgsField,
+                       QgsFields,
                        QgsProcessingContext,
                        QgsVectorLayer,
                        QgsRasterLayer,
+                       QgsRectangle,
+                       QgsCoordinateReferenceSystem,
                        QgsExpression,
+                       QgsExpressionContext,
+                       QgsExpressionContextUtils,
                        QgsTask,
-                       QgsUnitTypes)
-from qgis.PyQt.QtCore import QVariant
+                       QgsUnitTypes,
+                       NULL)
+from qgis.PyQt.QtCore import QVariant, QThread, QCoreApplication
 from qgis.PyQt.QtGui import QGuiApplication
+from qgis.PyQt import sip
 
 import shutil
+import csv
+import hashlib
+import json
 import os.path
 import sys
 import subprocess
 import time
+import threading
+import weakref
+import numpy as np
 
 import processing
 
-from . import utils, qgsUtils
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+from . import utils, qgsUtils, feedbacks
 
 nodata_val = '-9999'
 MEMORY_LAYER_NAME = 'memory:'
@@ -59,6 +84,12 @@ gtiff_copt_flag = False
 GTIFF_COPT = qgsUtils.GTIFF_COPT if gtiff_copt_flag else []
 gtiff_opts_pipe = '|'.join(GTIFF_COPT)
 gtiff_opts_comma = ','.join(GTIFF_COPT)
+# If True, raster calculator wrappers (applyRasterCalc, applyRasterCalcAB, ...)
+# evaluate formulas in-process instead of calling gdal:rastercalculator
+numpy_calc_flag = True
+# If True, raster wrappers called with a temporary output return deferred
+# LazyRaster nodes (or warped VRT) instead of writing temporary GeoTIFF files
+lazy_raster_flag = False
 
 gdal_calc_cmd = None
 gdal_merge_cmd = None
@@ -67,30 +98,485 @@ gdal_warp_cmd = None
 
 tmpOutput = QgsProcessing.TEMPORARY_OUTPUT
 
+# Processing results cache
+
+# Cache of processing results (utils.FileResultCache), disabled unless
+# initProcessingCache is called
+processing_cache = None
+# If True, processing results cache is neither read nor written
+processing_cache_bypass = False
+DEFAULT_PROCESSING_CACHE_SIZE = 2 * 1024 ** 3
+
+def initProcessingCache(cache_dir,max_size=DEFAULT_PROCESSING_CACHE_SIZE):
+    global processing_cache
+    processing_cache = utils.FileResultCache(cache_dir,max_size=max_size) if cache_dir else None
+    return processing_cache
+
+# Returns { algorithm : { "hits" : ..., "misses" : ..., "saved_seconds" : ... } }
+def getProcessingCacheReport():
+    return processing_cache.getReport() if processing_cache else {}
+
+# Returns JSON-serializable description of parameter value, input files being
+# described by their fingerprint. Raises ValueError if value cannot be described
+# (memory layers, unknown types).
+def processingCacheValue(value):
+    if isinstance(value,QgsMapLayer):
+        value = qgsUtils.pathOfLayer(value)
+        if not os.path.isfile(value):
+            raise ValueError("Layer " + str(value) + " is not a file")
+    if isinstance(value,(list,tuple)):
+        return [ processingCacheValue(v) for v in value ]
+    if isinstance(value,str):
+        path = value.split('|')[0]
+        return list(utils.fileFingerprint(path)) + [value] if os.path.isfile(path) else value
+    if value is None or isinstance(value,(bool,int,float)):
+        return value
+    if isinstance(value,QgsCoordinateReferenceSystem):
+        return value.authid() if value.authid() else value.toWkt()
+    if isinstance(value,QgsRectangle):
+        return value.toString()
+    if isinstance(value,QgsProperty):
+        return value.asExpression()
+    raise ValueError("Unexpected parameter value " + str(value))
+
+# Returns (key, destination parameters names) identifying processing call
+# from provider, algorithm, parameters and input files fingerprints.
+# Returns (None, None) if call cannot be cached.
+def processingCacheKey(complete_name,parameters):
+    alg = QgsApplication.processingRegistry().algorithmById(complete_name)
+    if alg is None:
+        return None, None
+    dest_names = [ p.name() for p in alg.destinationParameterDefinitions() ]
+    desc = { "alg" : complete_name, "qgis" : Qgis.QGIS_VERSION,
+        "provider" : alg.provider().versionInfo() if alg.provider() else None,
+        "params" : {} }
+    for name, value in parameters.items():
+        if name in dest_names:
+            if value is not None and (not isinstance(value,str) or value.startswith(MEMORY_LAYER_NAME)):
+                return None, None
+            continue
+        try:
+            desc["params"][name] = processingCacheValue(value)
+        except (ValueError, OSError):
+            return None, None
+    key = hashlib.sha256(json.dumps(desc,sort_keys=True).encode('utf-8')).hexdigest()
+    return key, dest_names
+
+# Returns processing result restored from cache, None if not found.
+# Output files are copied to requested destinations (temporary files if none).
+def restoreProcessingResult(key,complete_name,parameters,feedback):
+    entry = processing_cache.get(key,label=complete_name)
+    if entry is None:
+        return None
+    res = {}
+    for name, out in entry["outputs"].items():
+        if "value" in out:
+            res[name] = out["value"]
+            continue
+        dest = parameters.get(name,None)
+        if not dest or dest == tmpOutput:
+            dest = QgsProcessingUtils.generateTempFilename(os.path.basename(out["files"][0]))
+        res[name] = processing_cache.restore(key,name,dest)
+    feedback.pushInfo("Reused cached result of '" + complete_name
+        + "', saved " + str(entry["seconds"]) + " seconds")
+    return res
+
+# Stores processing result computed in 'seconds' in cache if possible
+def storeProcessingResult(key,dest_names,complete_name,parameters,res,seconds):
+    file_outputs = []
+    for name, value in res.items():
+        if isinstance(value,str) and os.path.isfile(value):
+            file_outputs.append(name)
+        elif isinstance(value,str) and os.path.isfile(value.split('|')[0]):
+            return
+        else:
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                return
+    for name in dest_names:
+        dest = parameters.get(name,None)
+        if dest and dest != tmpOutput and name not in file_outputs:
+            return
+    processing_cache.put(key,res,file_outputs,seconds,label=complete_name)
+
+# Processing profiler
+
+# If True, applyProcessingAlg records a profile of each call in processing_profile
+processing_profile_flag = False
+processing_profile = []
+PROCESSING_PROFILE_FIELDS = ["provider","alg","params_hash","start","wall_time",
+    "cpu_time","rss_delta","in_size","out_size","cached"]
+
+def resetProcessingProfile():
+    del processing_profile[:]
+
+# Returns peak resident set size of process in bytes (None if unavailable)
+def peakRSS():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Returns total size of files referenced by values (paths or layers)
+def valuesFilesSize(values):
+    size = 0
+    for value in values:
+        if isinstance(value,(list,tuple)):
+            size += valuesFilesSize(value)
+            continue
+        if isinstance(value,QgsMapLayer):
+            value = qgsUtils.pathOfLayer(value)
+        if isinstance(value,str) and os.path.isfile(value.split('|')[0]):
+            size += utils.filesSize(utils.datasetFiles(value.split('|')[0]))
+    return size
+
+# Returns (wall time, CPU time, peak RSS) at start of a processing call
+def profileStart():
+    return (time.time(), time.process_time(), peakRSS())
+
+# Returns values of input parameters (destination parameters excluded)
+def inputValues(complete_name,parameters):
+    alg = QgsApplication.processingRegistry().algorithmById(complete_name)
+    dest_names = [ p.name() for p in alg.destinationParameterDefinitions() ] if alg else []
+    return [ v for name, v in parameters.items() if name not in dest_names ]
+
+# Records profile of processing call, 'start' being returned by profileStart
+def profileEnd(start,provider,alg_name,parameters,res,cached):
+    start_time, start_cpu, start_rss = start
+    end_rss = peakRSS()
+    params_str = json.dumps(parameters,sort_keys=True,default=str)
+    processing_profile.append({ "provider" : provider, "alg" : alg_name,
+        "params_hash" : hashlib.sha256(params_str.encode('utf-8')).hexdigest()[:16],
+        "start" : start_time,
+        "wall_time" : time.time() - start_time,
+        "cpu_time" : time.process_time() - start_cpu,
+        "rss_delta" : None if start_rss is None else end_rss - start_rss,
+        "in_size" : valuesFilesSize(inputValues(provider + ":" + alg_name,parameters)),
+        "out_size" : valuesFilesSize(res.values()) if res else 0,
+        "cached" : cached })
+
+# Returns per-algorithm profile summary sorted by decreasing total wall time
+def getProcessingProfileSummary():
+    summary = {}
+    for record in processing_profile:
+        name = record["provider"] + ":" + record["alg"]
+        entry = summary.setdefault(name,{ "alg" : name, "calls" : 0, "cached" : 0,
+            "wall_time" : 0.0, "cpu_time" : 0.0, "max_rss_delta" : None,
+            "in_size" : 0, "out_size" : 0 })
+        entry["calls"] += 1
+        entry["cached"] += 1 if record["cached"] else 0
+        for k in ["wall_time","cpu_time","in_size","out_size"]:
+            entry[k] += record[k]
+        if record["rss_delta"] is not None:
+            entry["max_rss_delta"] = max(entry["max_rss_delta"] or 0,record["rss_delta"])
+    return sorted(summary.values(),key=lambda e : e["wall_time"],reverse=True)
+
+# Saves processing profile records to CSV (';' delimiter) or JSON file
+# (depending on extension). If 'summary' is True, saves per-algorithm summary.
+def saveProcessingProfile(fname,summary=False):
+    records = getProcessingProfileSummary() if summary else processing_profile
+    if os.path.splitext(fname)[1].lower() == ".json":
+        with open(fname,"w") as f:
+            json.dump(records,f,indent=1)
+    else:
+        fieldnames = list(records[0].keys()) if records else PROCESSING_PROFILE_FIELDS
+        with open(fname,"w",newline='') as f:
+            writer = csv.DictWriter(f,fieldnames=fieldnames,delimiter=';')
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+
+# Pushes to feedback the table of the 'nb' slowest algorithms
+def reportProcessingProfile(feedback,nb=10):
+    summary = getProcessingProfileSummary()
+    total = sum(e["wall_time"] for e in summary)
+    feedback.pushInfo("Slowest processing algorithms (" + str(len(processing_profile))
+        + " calls, " + "{:.2f}".format(total) + " seconds) :")
+    feedback.pushInfo("{:<40} {:>6} {:>6} {:>10} {:>10} {:>6}".format(
+        "algorithm","calls","cached","wall (s)","cpu (s)","%"))
+    for e in summary[:nb]:
+        feedback.pushInfo("{:<40} {:>6} {:>6} {:>10.2f} {:>10.2f} {:>6.1f}".format(
+            e["alg"],e["calls"],e["cached"],e["wall_time"],e["cpu_time"],
+            100 * e["wall_time"] / total if total else 0))
+
+# Processing contexts
+
+# Stack of contexts of ProcessingContextScope, for each thread
+processing_contexts = threading.local()
+
+# Context manager sharing a QgsProcessingContext between processing calls of
+# current thread (used by applyProcessingAlg when no context is given).
+# Layers loaded from paths by an algorithm are kept in context temporary layer
+# store and reused by next algorithms instead of being re-opened from disk.
+# Nested scopes share outermost context unless 'context' is given.
+# Temporary layer store is cleared when leaving the scope that created context.
+#
+#   with ProcessingContextScope(feedback) as context:
+#       applyProcessingAlg(...)
+class ProcessingContextScope:
+
+    def __init__(self,feedback=None,context=None):
+        self.feedback = feedback
+        self.context = context
+        self.owned = False
+
+    def __enter__(self):
+        stack = getattr(processing_contexts,"stack",None)
+        if stack is None:
+            stack = processing_contexts.stack = []
+        if self.context is None:
+            if stack:
+                self.context = stack[-1]
+            else:
+                self.context = QgsProcessingContext()
+                self.context.setProject(QgsProject.instance())
+                if self.feedback is not None:
+                    self.context.setFeedback(self.feedback)
+                self.owned = True
+        stack.append(self.context)
+        return self.context
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        processing_contexts.stack.pop()
+        if self.owned:
+            self.context.temporaryLayerStore().removeAllMapLayers()
+        return False
+
+# Contexts used by processing calls : { context : paths to release }.
+# Their temporary layer stores are released when a file is written or
+# deleted (see utils.releaseFile), immediately if context belongs to
+# current thread, otherwise when context is next used.
+used_contexts = weakref.WeakKeyDictionary()
+used_contexts_lock = threading.Lock()
+
+def registerContext(context):
+    with used_contexts_lock:
+        paths = used_contexts.setdefault(context,set())
+        pending, paths_copy = bool(paths), list(paths)
+        paths.clear()
+    if pending:
+        releaseContextLayers(context,paths_copy)
+    return context
+
+def releaseFileContextLayers(path):
+    with used_contexts_lock:
+        contexts = list(used_contexts.items())
+    for context, paths in contexts:
+        if sip.isdeleted(context):
+            continue
+        if context.thread() == QThread.currentThread():
+            releaseContextLayers(context,[path])
+        else:
+            with used_contexts_lock:
+                paths.add(path)
+
+utils.file_release_hooks.append(releaseFileContextLayers)
+
+# Returns context for a processing call : 'context' if given and owned by
+# current thread, context of current ProcessingContextScope if any, or new context.
+def getProcessingContext(context=None,feedback=None):
+    if context is not None and context.thread() == QThread.currentThread():
+        return registerContext(context)
+    stack = getattr(processing_contexts,"stack",None)
+    if stack:
+        return registerContext(stack[-1])
+    context = QgsProcessingContext()
+    context.setFeedback(feedback)
+    return context
+
+# Removes from context temporary layer store layers loaded from 'paths'
+# or from files in folders 'paths' (e.g. outputs overwritten by an
+# algorithm or files rewritten outside processing) so that they are not reused
+def releaseContextLayers(context,paths):
+    paths = [ utils.normPath(p) for p in paths if p ]
+    if not paths:
+        return
+    store = context.temporaryLayerStore()
+    for layer_id, layer in list(store.mapLayers().items()):
+        layer_path = utils.normPath(qgsUtils.pathOfLayer(layer))
+        if any(layer_path == p or layer_path.startswith(p + '/') for p in paths):
+            store.removeMapLayer(layer_id)
+
+# Releases files of destination parameters (see utils.releaseFile)
+# before they are overwritten by algorithm
+def releaseOutputFiles(complete_name,parameters):
+    alg = QgsApplication.processingRegistry().algorithmById(complete_name)
+    if alg is None:
+        return
+    for param in alg.destinationParameterDefinitions():
+        value = parameters.get(param.name(),None)
+        if (isinstance(value,str) and value and value != tmpOutput
+                and not value.startswith(MEMORY_LAYER_NAME)):
+            utils.releaseFile(value)
+
+# Memory-first vector pipelines
+
+# Default number of features beyond which memory layers are spilled to disk
+DEFAULT_MEMORY_SPILL_FEATURES = 500000
+
+# Stack of MemoryPipeline scopes, for each thread
+memory_pipelines = threading.local()
+
+# Context manager in which intermediate vector outputs of processing calls stay
+# in memory. Vector outputs given as temporary (tmpOutput) or registered as
+# intermediate (see addIntermediate) are replaced by memory layers, which
+# applyProcessingAlg returns and which can be given as input to next steps.
+# Only final outputs (other paths) are written to disk. To bound peak memory,
+# outputs of algorithms whose biggest vector input has more than
+# 'max_features' features are written to disk as requested instead of memory.
+# Memory outputs still exceeding 'max_features' features (e.g. when algorithm
+# creates more features than its inputs) are spilled to a temporary
+# GeoPackage file (whose path is returned instead) before being retained.
+# Memory layers are released when leaving the pipeline.
+#
+#   with MemoryPipeline() as pipeline:
+#       clipped = applyVectorClip(input,clip_layer,tmpOutput,feedback=feedback)
+#       dissolveLayer(clipped,out_path,feedback=feedback)
+class MemoryPipeline:
+
+    def __init__(self,max_features=DEFAULT_MEMORY_SPILL_FEATURES,intermediates=[]):
+        self.max_features = max_features
+        self.intermediates = set(utils.normPath(p) for p in intermediates)
+        self.layers = []
+
+    def __enter__(self):
+        stack = getattr(memory_pipelines,"stack",None)
+        if stack is None:
+            stack = memory_pipelines.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        memory_pipelines.stack.remove(self)
+        self.layers = []
+        return False
+
+    # Registers 'path' as an intermediate output to be kept in memory
+    def addIntermediate(self,path):
+        self.intermediates.add(utils.normPath(path))
+
+    def isIntermediate(self,dest):
+        if dest == tmpOutput:
+            return True
+        return isinstance(dest,str) and utils.normPath(dest) in self.intermediates
+
+    # Returns maximum feature count of vector inputs (layers or paths)
+    @staticmethod
+    def inputsFeatureCount(alg,parameters,context):
+        dest_names = [ p.name() for p in alg.destinationParameterDefinitions() ]
+        res = 0
+        for name, value in parameters.items():
+            if name in dest_names:
+                continue
+            for v in (value if isinstance(value,list) else [value]):
+                layer = v
+                if isinstance(v,str) and os.path.isfile(v.split('|')[0]):
+                    layer = QgsProcessingUtils.mapLayerFromString(v,context)
+                if isinstance(layer,QgsVectorLayer):
+                    res = max(res,layer.featureCount())
+        return res
+
+    # Returns parameters with intermediate vector outputs replaced by memory
+    # outputs, unless inputs are too big to keep outputs in memory
+    def prepareParameters(self,complete_name,parameters,context):
+        alg = QgsApplication.processingRegistry().algorithmById(complete_name)
+        if alg is None or alg.provider() is None or not alg.provider().supportsNonFileBasedOutput():
+            return parameters
+        if self.inputsFeatureCount(alg,parameters,context) > self.max_features:
+            return parameters
+        res = dict(parameters)
+        for param in alg.destinationParameterDefinitions():
+            name = param.name()
+            if param.type() in ['sink','vectorDestination'] and self.isIntermediate(res.get(name,None)):
+                res[name] = MEMORY_LAYER_NAME
+        return res
+
+    # Keeps memory layers of result alive, spilling big ones to disk.
+    # Processing returns memory outputs as ids of layers of context temporary
+    # layer store : they are taken from store (which may be destroyed with
+    # context) and owned by pipeline, layer object being returned instead of id.
+    def processResult(self,res,context,feedback=None):
+        store = context.temporaryLayerStore()
+        for name, value in res.items():
+            if not isinstance(value,str):
+                continue
+            layer = store.mapLayer(value)
+            if not isinstance(layer,QgsVectorLayer) or layer.providerType() != 'memory':
+                continue
+            layer = context.takeResultLayer(value)
+            if layer is None:
+                continue
+            if layer.featureCount() > self.max_features:
+                path = QgsProcessingUtils.generateTempFilename(name + '.gpkg')
+                if feedback:
+                    feedback.pushInfo("Spilling memory layer (" + str(layer.featureCount())
+                        + " features) to " + str(path))
+                qgsUtils.writeVectorLayer(layer,path)
+                res[name] = path
+            else:
+                self.layers.append(layer)
+                res[name] = layer
+        return res
+
+# Returns innermost MemoryPipeline of current thread, None if not in pipeline
+def currentMemoryPipeline():
+    stack = getattr(memory_pipelines,"stack",None)
+    return stack[-1] if stack else None
+
 # Processing call wrappers
 
+# If 'use_cache' is False, processing results cache is bypassed for this call.
+# If 'background' is True, algorithm is run in a QgsTask and task handle is
+# returned (see applyProcessingAlgInBackground).
 def applyProcessingAlg(provider,alg_name,parameters,context=None,
-        feedback=None,onlyOutput=True):
+        feedback=None,onlyOutput=True,use_cache=True,background=False):
     # Dummy function to enable running an alg inside an alg
     def no_post_process(alg, context, feedback):
         pass
+    if background:
+        return applyProcessingAlgInBackground(provider,alg_name,parameters,
+            feedback=feedback,onlyOutput=onlyOutput)
     if feedback is None:
         utils.internal_error("No feedback")
+    if any(isinstance(v,(LazyRaster,list)) for v in parameters.values()):
+        parameters = { k : materializeLazy(v,feedback=feedback)
+            for k, v in parameters.items() }
     feedback.pushDebugInfo("parameters : " + str(parameters))
-    QGuiApplication.processEvents()
+    # Events can only be processed from main thread (not in model workers)
+    app = QCoreApplication.instance()
+    if app and QThread.currentThread() == app.thread():
+        QGuiApplication.processEvents()
     try:
         complete_name = provider + ":" + alg_name
         feedback.pushInfo("Calling processing algorithm '" + complete_name + "'")
         start_time = time.time()
-        context = None
         #utils.debug("context = " + str(context))
-        if context is None:
-            context = QgsProcessingContext()
-            context.setFeedback(feedback)
+        context = getProcessingContext(context,feedback)
+        pipeline = currentMemoryPipeline()
+        if pipeline:
+            parameters = pipeline.prepareParameters(complete_name,parameters,context)
         feedback.pushDebugInfo("complete_name = " + str(complete_name))
         feedback.pushDebugInfo("feedback = " + str(feedback.__class__.__name__))
         # assert(False)
-        res = processing.run(complete_name,parameters,onFinish=no_post_process,context=context,feedback=feedback)
+        cache_key, res = None, None
+        profile_start = profileStart() if processing_profile_flag else None
+        if use_cache and processing_cache is not None and not processing_cache_bypass:
+            cache_key, dest_names = processingCacheKey(complete_name,parameters)
+            if cache_key:
+                res = restoreProcessingResult(cache_key,complete_name,parameters,feedback)
+        cached = res is not None
+        if res is None:
+            releaseOutputFiles(complete_name,parameters)
+            res = processing.run(complete_name,parameters,onFinish=no_post_process,context=context,feedback=feedback)
+            if cache_key:
+                storeProcessingResult(cache_key,dest_names,complete_name,parameters,
+                    res,time.time() - start_time)
+        releaseContextLayers(context,[ v for v in res.values() if isinstance(v,str) ])
+        if pipeline:
+            res = pipeline.processResult(res,context,feedback=feedback)
+        if profile_start:
+            profileEnd(profile_start,provider,alg_name,parameters,res,cached)
         #res = processing.runAndLoadResults(complete_name,parameters,context=context,feedback=feedback)#,onFinish=no_post_process)
         feedback.pushDebugInfo("res1 = " + str(res))
         end_time = time.time()
@@ -116,24 +602,98 @@ def applyProcessingAlg(provider,alg_name,parameters,context=None,
     finally:
         feedback.pushDebugInfo("End run " + alg_name)
 
-# class ProcessingAlgTask(QgsTask):
-
-    # def __init__(self,provider,algName,parameters,context=None,feedback=None,onlyOutput=None):
-        # self.provider = provider
-        # self.algName = algName
-        # self.parameters = parameters
-        # self.context = context
-        # self.feedback = feedback
-        # self.onlyOutput = onlyOutput
-
-    # def run(self):
-        # return applyProcessingAlgFunc(self.provider,algName,parameters,
-            # context=context,feedback=feedback,onlyOutput=onlyOutput)
-
-# def applyProcessingAlg(provider,algName,parameters,context=None,
-        # feedback=None,onlyOutput=True,background=True):
-    # task = ProcessingAlgTask(provider,algName,parameters,context=context,
-        # feedback=feedback,onlyOutput=onlyOutput)
+# Background execution of a processing algorithm in a QgsTask, with a
+# future-like interface (done, result, exception, cancel).
+# Algorithm messages are recorded and forwarded to 'feedback' once task is
+# finished (or when result is requested). Canceling 'feedback' cancels task.
+# Parameters should not contain layer objects owned by main thread (use paths).
+class ProcessingAlgTask(QgsTask):
+
+    def __init__(self,provider,alg_name,parameters,feedback=None,onlyOutput=True):
+        super().__init__("Processing algorithm " + provider + ":" + alg_name,QgsTask.CanCancel)
+        self.provider = provider
+        self.alg_name = alg_name
+        self.parameters = parameters
+        self.onlyOutput = onlyOutput
+        self.caller_feedback = feedback
+        self.task_feedback = feedbacks.BufferedFeedback()
+        self.task_feedback.progressChanged.connect(self.setProgress)
+        if feedback is not None:
+            feedback.canceled.connect(self.cancel)
+        self.res = None
+        self.error = None
+        self.end_event = threading.Event()
+
+    def run(self):
+        try:
+            # Context is created in task thread
+            self.res = applyProcessingAlg(self.provider,self.alg_name,self.parameters,
+                context=None,feedback=self.task_feedback,onlyOutput=self.onlyOutput)
+            return True
+        except Exception as e:
+            self.error = e
+            return False
+        finally:
+            self.end_event.set()
+
+    # No-op once task has been deleted by task manager
+    def cancel(self):
+        if sip.isdeleted(self):
+            return
+        self.task_feedback.cancel()
+        super().cancel()
+
+    # Called from main thread when task ends (including cancellation),
+    # task being deleted afterwards by task manager
+    def finished(self,result):
+        if self.caller_feedback is not None:
+            try:
+                self.caller_feedback.canceled.disconnect(self.cancel)
+            except (TypeError, RuntimeError):
+                pass
+        self.forwardMessages()
+
+    def forwardMessages(self):
+        if self.caller_feedback is not None:
+            self.task_feedback.replay(self.caller_feedback)
+
+    def done(self):
+        return self.end_event.is_set()
+
+    # Waits for task end and returns algorithm error if any
+    def exception(self,timeout=None):
+        if not self.end_event.wait(timeout):
+            raise TimeoutError("Timeout waiting for " + self.description())
+        return self.error
+
+    # Waits for task end and returns algorithm result (raises algorithm error)
+    def result(self,timeout=None):
+        error = self.exception(timeout)
+        self.forwardMessages()
+        if error is not None:
+            raise error
+        return self.res
+
+# Runs processing algorithm in background with QGIS task manager and returns
+# task handle (see ProcessingAlgTask), several tasks running concurrently.
+def applyProcessingAlgInBackground(provider,alg_name,parameters,
+        feedback=None,onlyOutput=True):
+    task = ProcessingAlgTask(provider,alg_name,parameters,
+        feedback=feedback,onlyOutput=onlyOutput)
+    QgsApplication.taskManager().addTask(task)
+    return task
+
+# Waits for background processing tasks while keeping GUI responsive and
+# returns their results in tasks order. Canceling 'feedback' cancels tasks.
+def waitProcessingTasks(tasks,feedback=None):
+    while not all(task.done() for task in tasks):
+        if feedback is not None and feedback.isCanceled():
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        QCoreApplication.processEvents()
+        time.sleep(0.05)
+    return [ task.result() for task in tasks ]
 
 
 def checkGrass7Installed():
@@ -209,78 +769,100 @@ def qgsTypeToInt(qgis_type,shift=False,typeList=2,defaultType=Qgis.DataType.Floa
 
 # Custom treatments
 
-def selectGeomByExpression(in_layer,expr,out_path,out_name):
+# Writes to 'out_path' geometries of 'in_layer' features matching 'expr'
+# (all features if None) with an 'Origin' field containing layer name.
+# Features are streamed to file by batches of 'batch_size'.
+def selectGeomByExpression(in_layer,expr,out_path,out_name,
+        batch_size=qgsUtils.FEATURES_BATCH_SIZE):
     #utils.info("Calling 'selectGeomByExpression' algorithm")
     start_time = time.time()
     qgsUtils.removeVectorLayer(out_path)
     if isinstance(in_layer,str):
         in_layer = qgsUtils.loadVectorLayer(in_layer)
-    out_layer = qgsUtils.createLayerFromExisting(in_layer,out_name)
-    orig_field = QgsField("Origin", QVariant.String)
-    out_layer.dataProvider().addAttributes([orig_field])
-    out_layer.updateFields()
-    fields = out_layer.fields()
-    out_provider = out_layer.dataProvider()
+    fields = QgsFields()
+    fields.append(QgsField("Origin", QVariant.String))
+    writer = qgsUtils.createVectorWriter(out_path,fields,in_layer.wkbType(),in_layer.crs())
     in_name = in_layer.name()
+    request = QgsFeatureRequest().setNoAttributes()
     if expr:
-        feats = in_layer.getFeatures(QgsFeatureRequest().setFilterExpression(expr))
-    else:
-        feats = in_layer.getFeatures(QgsFeatureRequest())
-    for f in feats:
-        geom = f.geometry()
-        new_f = QgsFeature(fields)
-        new_f.setGeometry(geom)
-        new_f["Origin"] = in_layer.name()
-        res = out_provider.addFeature(new_f)
-        if not res:
-            internal_error("addFeature failed")
-    out_layer.updateExtents()
-    qgsUtils.writeVectorLayer(out_layer,out_path)
+        request.setFilterExpression(expr)
+    def newFeatures():
+        for f in in_layer.getFeatures(request):
+            new_f = QgsFeature(fields)
+            new_f.setGeometry(f.geometry())
+            new_f["Origin"] = in_name
+            yield new_f
+    qgsUtils.addFeaturesByBatch(writer,newFeatures(),batch_size=batch_size)
+    writer = None # Close file
     end_time = time.time()
     diff_time = end_time - start_time
     #utils.info("Call to 'selectGeomByExpression' successful"
     #           + ", performed in " + str(diff_time) + " seconds")
 
-def classifByExpr(in_layer,expr,out_path,out_name):
+# Returns truth value of expression result as QGIS filters do (None if NULL
+# or if result is a non numeric string, which QGIS treats as an error)
+def expressionTruth(value):
+    if value is None or value == NULL:
+        return None
+    if isinstance(value,str):
+        try:
+            return float(value) != 0
+        except ValueError:
+            return None
+    return bool(value)
+
+# Writes to 'out_path' geometries of 'in_layer' features with a 'Value' field
+# set to 1 if feature matches 'expr' (all features if None), 0 if it matches
+# NOT(expr), and an 'Origin' field containing layer name. Features for which
+# 'expr' is NULL (or a non numeric string) are ignored. Expression is prepared once and evaluated once
+# per feature in a single pass over input layer.
+# Features are streamed to file by batches of 'batch_size'.
+def classifByExpr(in_layer,expr,out_path,out_name,
+        batch_size=qgsUtils.FEATURES_BATCH_SIZE):
     #utils.info("Calling 'selectGeomByExpression' algorithm")
     qgsUtils.removeVectorLayer(out_path)
     if isinstance(in_layer,str):
         in_layer = qgsUtils.loadVectorLayer(in_layer)
-    out_layer = qgsUtils.createLayerFromExisting(in_layer,out_name)
-    value_field = QgsField("Value", QVariant.Int)
-    orig_field = QgsField("Origin", QVariant.String)
-    out_layer.dataProvider().addAttributes([value_field,orig_field])
-    out_layer.updateFields()
-    fields = out_layer.fields()
-    out_provider = out_layer.dataProvider()
-    in_name = in_layer.name()
+    request = QgsFeatureRequest()
+    expression = None
     if expr:
-        feats = in_layer.getFeatures(QgsFeatureRequest().setFilterExpression(expr))
+        expression = QgsExpression(expr)
+        if expression.hasParserError():
+            utils.user_error("Invalid expression '" + str(expr) + "' : "
+                + str(expression.parserErrorString()))
+        exp_context = QgsExpressionContext(
+            QgsExpressionContextUtils.globalProjectLayerScopes(in_layer))
+        expression.prepare(exp_context)
+        columns = expression.referencedColumns()
+        if QgsFeatureRequest.ALL_ATTRIBUTES not in columns:
+            request.setSubsetOfAttributes(list(columns),in_layer.fields())
     else:
-        feats = in_layer.getFeatures(QgsFeatureRequest())
-    for f in feats:
-        geom = f.geometry()
-        new_f = QgsFeature(fields)
-        new_f.setGeometry(geom)
-        new_f["Value"] = 1
-        new_f["Origin"] = in_layer.name()
-        res = out_provider.addFeature(new_f)
-        if not res:
-            internal_error("addFeature failed")
-    if expr:
-        not_expr = "NOT(" + str(expr) + ")"
-        feats = in_layer.getFeatures(QgsFeatureRequest().setFilterExpression(not_expr))
-        for f in feats:
-            geom = f.geometry()
+        request.setNoAttributes()
+    fields = QgsFields()
+    fields.append(QgsField("Value", QVariant.Int))
+    fields.append(QgsField("Origin", QVariant.String))
+    writer = qgsUtils.createVectorWriter(out_path,fields,in_layer.wkbType(),in_layer.crs())
+    in_name = in_layer.name()
+    def newFeatures():
+        for f in in_layer.getFeatures(request):
+            if expression is None:
+                value = 1
+            else:
+                exp_context.setFeature(f)
+                truth = expressionTruth(expression.evaluate(exp_context))
+                if expression.hasEvalError():
+                    utils.user_error("Could not evaluate expression '" + str(expr)
+                        + "' : " + str(expression.evalErrorString()))
+                if truth is None:
+                    continue
+                value = 1 if truth else 0
             new_f = QgsFeature(fields)
-            new_f.setGeometry(geom)
-            new_f["Value"] = 0
-            new_f["Origin"] = in_layer.name()
-            res = out_provider.addFeature(new_f)
-            if not res:
-                internal_error("addFeature failed")
-    out_layer.updateExtents()
-    qgsUtils.writeVectorLayer(out_layer,out_path)
+            new_f.setGeometry(f.geometry())
+            new_f["Value"] = value
+            new_f["Origin"] = in_name
+            yield new_f
+    qgsUtils.addFeaturesByBatch(writer,newFeatures(),batch_size=batch_size)
+    writer = None # Close file
 
 # Processing utils
 
@@ -717,6 +1299,13 @@ def applyReclassifyByTable(input,table,output,
                            nodata_val=nodata_val,out_type=Qgis.DataType.Float32,
                            boundaries_mode=1,nodata_missing=True,
                            context=None,feedback=None):
+    if nodata_val is not None:
+        params = { 'table' : table, 'boundaries_mode' : boundaries_mode,
+            'nodata_missing' : nodata_missing, 'nodata' : nodata_val,
+            'type_name' : GDAL_CALC_TYPES[qgsTypeToInt(out_type,shift=True)] }
+        res = applyLazyPixelOp('reclass',{ 'A' : input },output,params,feedback=feedback)
+        if res is not None:
+            return res
     # Types : 0 = Byte, ...
     parameters = { 'DATA_TYPE' : qgsTypeToInt(out_type,shift=True),
                    'INPUT_RASTER' : input,
@@ -821,6 +1410,23 @@ def applyWarpReproject(in_path,out_path,resampling_mode='near',dst_crs=None,
     # Output type
     TYPES = ['Use input layer data type', 'Byte', 'Int16', 'UInt16', 'UInt32', 'Int32',
              'Float32', 'Float64', Qgis.DataType.CInt16, Qgis.DataType.CInt32, 'CFloat32', 'CFloat64']
+    # Lazy mode : warped VRT
+    type_idx = qgsTypeToInt(out_type)
+    if (lazy_raster_flag and type_idx <= len(GDAL_CALC_TYPES) and extent_crs is None
+            and (extent is None or isinstance(extent,QgsRectangle))):
+        warp_opts = { 'resampleAlg' : resampling_mode,
+            'srcSRS' : lazyWarpCrs(src_crs) if src_crs else None,
+            'dstSRS' : lazyWarpCrs(dst_crs) if dst_crs else None,
+            'outputBounds' : (extent.xMinimum(),extent.yMinimum(),
+                extent.xMaximum(),extent.yMaximum()) if extent else None,
+            'xRes' : resolution if resolution else None,
+            'yRes' : resolution if resolution else None,
+            'outputType' : gdal.GetDataTypeByName(GDAL_CALC_TYPES[type_idx - 1])
+                if type_idx > 0 else None,
+            'dstNodata' : nodata_val }
+        res = applyLazyWarp(in_path,out_path,warp_opts,feedback=feedback)
+        if res is not None:
+            return res
     # Parameters
     parameters = { 'DATA_TYPE' : qgsTypeToInt(out_type),
                    'INPUT' : in_path,
@@ -855,6 +1461,27 @@ def clipRasterFromVector(raster_path,vector_path,out_path,
                          context=None,feedback=None):
     # data type 0 = input raster type
     feedback.setProgressText("Clip raster")
+    # Lazy mode : warped VRT with cutline
+    mask_path = (qgsUtils.pathOfLayer(vector_path)
+        if isinstance(vector_path,QgsVectorLayer) else vector_path)
+    type_idx = qgsTypeToInt(data_type)
+    if (lazy_raster_flag and out_path == tmpOutput
+            and type_idx <= len(GDAL_CALC_TYPES) and isinstance(mask_path,str)):
+        src_path = rasterInputPath(raster_path)
+        res_x, res_y = (resolution, resolution) if resolution else (x_res, y_res)
+        if keep_res and not (res_x and res_y) and src_path:
+            geo_transform = gdal.Open(src_path).GetGeoTransform()
+            res_x, res_y = geo_transform[1], abs(geo_transform[5])
+        warp_opts = { 'cutlineDSName' : mask_path,
+            'cropToCutline' : crop_cutline,
+            'xRes' : res_x if res_x and res_y else None,
+            'yRes' : res_y if res_x and res_y else None,
+            'outputType' : gdal.GetDataTypeByName(GDAL_CALC_TYPES[type_idx - 1])
+                if type_idx > 0 else None,
+            'dstNodata' : nodata }
+        res = applyLazyWarp(raster_path,out_path,warp_opts,feedback=feedback)
+        if res is not None:
+            return res
     parameters = { 'ALPHA_BAND' : False,
                    'CROP_TO_CUTLINE' : crop_cutline,
                    'DATA_TYPE' : qgsTypeToInt(data_type),
@@ -951,11 +1578,84 @@ def applyRasterCalcNative(layers,expr,output,
     return applyProcessingAlg("native","rastercalc",parameters,
         context,feedback)
 
+# Output types of gdal:rastercalculator ('RTYPE' parameter)
+GDAL_CALC_TYPES = ['Byte', 'Int16', 'UInt16', 'UInt32', 'Int32', 'Float32', 'Float64']
+GDAL_CALC_NUMPY_TYPES = { 'Byte' : np.uint8, 'Int16' : np.int16, 'UInt16' : np.uint16,
+    'UInt32' : np.uint32, 'Int32' : np.int32, 'Float32' : np.float32, 'Float64' : np.float64 }
+# NoData values used by gdal_calc when none is given
+GDAL_CALC_DEFAULT_NODATA = { 'Byte' : 255, 'UInt16' : 65535, 'Int16' : -32767,
+    'UInt32' : 4294967293, 'Int32' : -2147483647,
+    'Float32' : 3.402823466E+38, 'Float64' : 1.7976931348623158E+308 }
+
+# Returns path of raster input (path, QgsRasterLayer or LazyRaster), None if not a file
+def rasterInputPath(input):
+    if isinstance(input,LazyRaster):
+        return input.materialize()
+    if isinstance(input,QgsRasterLayer):
+        input = qgsUtils.pathOfLayer(input)
+    if isinstance(input,str) and os.path.isfile(input):
+        return input
+    return None
+
+# Evaluates gdal:rastercalculator formula 'expr' in-process, block by block
+# (see qgsUtils.applyNumpyCalc). Inputs are given as { 'A' : input_a, ... }.
+# Returns None if call cannot be handled in-process (flag disabled, non-file
+# inputs, inputs of different dimensions or non-GeoTIFF output), in which case
+# caller falls back to processing algorithm.
+# If 'merge_nodata' is True, inputs A and B are combined with NoData merging
+# (see qgsUtils.applyNumpyCalcABNull) instead of gdal_calc NoData semantics.
+def applyRasterCalcInProcess(inputs,output,expr,nodata_val=nodata_val,
+        out_type=Qgis.DataType.Float32,bands=None,merge_nodata=False,feedback=None):
+    type_name = GDAL_CALC_TYPES[qgsTypeToInt(out_type,shift=True)]
+    if nodata_val is None:
+        nodata_val = GDAL_CALC_DEFAULT_NODATA[type_name]
+    if bands is None:
+        params = { 'expr' : expr, 'merge_nodata' : merge_nodata,
+            'type_name' : type_name, 'nodata' : nodata_val }
+        res = applyLazyPixelOp('calc',inputs,output,params,feedback=feedback)
+        if res is not None:
+            return res
+    if not numpy_calc_flag:
+        return None
+    paths = {}
+    dims = set()
+    for name, input in inputs.items():
+        path = rasterInputPath(input)
+        raster = gdal.Open(path) if path else None
+        if not raster:
+            return None
+        paths[name] = path
+        dims.add((raster.RasterXSize,raster.RasterYSize))
+    if len(dims) != 1:
+        return None
+    if output == tmpOutput:
+        output = QgsProcessingUtils.generateTempFilename('OUTPUT.tif')
+    if not isinstance(output,str) or os.path.splitext(output)[1].lower() not in ['.tif','.tiff']:
+        return None
+    if feedback:
+        feedback.pushInfo("Evaluating raster formula '" + str(expr) + "' in-process")
+    start_time = time.time()
+    gdal_type = gdal.GetDataTypeByName(type_name)
+    if merge_nodata:
+        qgsUtils.applyNumpyCalcABNull(paths['A'],paths['B'],output,expr,nodata_val,
+            out_type=gdal_type,feedback=feedback)
+    else:
+        qgsUtils.applyNumpyCalc(paths,output,expr,nodata=nodata_val,
+            out_type=gdal_type,bands=bands,feedback=feedback)
+    diff_time = time.time() - start_time
+    if feedback:
+        feedback.pushInfo("Raster formula evaluated in " + str(diff_time) + " seconds")
+    return output
+
 def applyRasterCalcProc(input_a,output,expr,
                     nodata_val=nodata_val,out_type=Qgis.DataType.Float32,
                     context=None,feedback=None):
     TYPE = ['Byte', 'Int16', 'UInt16', 'UInt32', 'Int32', 'Float32', 'Float64']
     feedback.setProgressText("Raster Calc")
+    res = applyRasterCalcInProcess({ 'A' : input_a },output,expr,
+        nodata_val=nodata_val,out_type=out_type,feedback=feedback)
+    if res is not None:
+        return res
     parameters = { 'BAND_A' : 1,
                    'FORMULA' : expr,
                    'INPUT_A' : input_a,
@@ -975,9 +1675,8 @@ def applyRasterCalc(input_a,output,expr,
     if isinstance(input_a,QgsRasterLayer):
         input_a = qgsUtils.pathOfLayer(input_a)
     #applyGdalCalc(input_a,output,expr,type=type_str,nodata=nodata_val)
-    applyRasterCalcProc(input_a,output,expr,nodata_val=nodata_val,
+    return applyRasterCalcProc(input_a,output,expr,nodata_val=nodata_val,
         out_type=out_type,context=context,feedback=feedback)
-    return output
 
 def applyRasterCalcLT(input,output,max_val,
                       nodata_val=nodata_val,out_type=Qgis.DataType.Float32,
@@ -997,6 +1696,10 @@ def applyRasterCalcAB(input_a,input_b,output,expr,
                     nodata_val=nodata_val,out_type=Qgis.DataType.Float32,
                     context=None,feedback=None):
     TYPE = ['Byte', 'Int16', 'UInt16', 'UInt32', 'Int32', 'Float32', 'Float64']
+    res = applyRasterCalcInProcess({ 'A' : input_a, 'B' : input_b },output,expr,
+        nodata_val=nodata_val,out_type=out_type,feedback=feedback)
+    if res is not None:
+        return res
     parameters = { 'BAND_A' : 1,
                    'BAND_B' : 1,
                    'FORMULA' : expr,
@@ -1013,6 +1716,11 @@ def applyRasterCalcABC(input_a,input_b,input_c, band_a, band_b, band_c, output,e
                     nodata_val=None,out_type=Qgis.DataType.Float32,
                     context=None,feedback=None):
     TYPE = ['Byte', 'Int16', 'UInt16', 'UInt32', 'Int32', 'Float32', 'Float64']
+    res = applyRasterCalcInProcess({ 'A' : input_a, 'B' : input_b, 'C' : input_c },
+        output,expr,nodata_val=nodata_val,out_type=out_type,
+        bands={ 'A' : band_a, 'B' : band_b, 'C' : band_c },feedback=feedback)
+    if res is not None:
+        return res
     parameters = { 'BAND_A' : band_a,
                    'BAND_B' : band_b,
                    'BAND_C' : band_c,
@@ -1032,6 +1740,10 @@ def applyRasterCalcAB_ABNull(input_a,input_b,output,expr,
     TYPE = ['Byte', 'Int16', 'UInt16', 'UInt32', 'Int32', 'Float32', 'Float64']
     if os.path.isfile(output):
         qgsUtils.removeRaster(output)
+    res = applyRasterCalcInProcess({ 'A' : input_a, 'B' : input_b },output,expr,
+        nodata_val=nodata_val,out_type=out_type,merge_nodata=True,feedback=feedback)
+    if res is not None:
+        return res
     tmp_no_data_val = -998
     nd_str = str(tmp_no_data_val)
     nonull_a = QgsProcessingUtils.generateTempFilename("nonull_a.tif")
@@ -1073,7 +1785,6 @@ def applyRasterCalcMult(input_a,input_b,output,
 def applyRasterCalcMin(input_a,input_b,output,
                        nodata_val=nodata_val,out_type=Qgis.DataType.Float32,
                        context=None,feedback=None):
-    min = qgsUtils.getRastersMinMax([input_a,input_b])
     expr = 'A*less_equal(A,B) + B*less(B,A)'
     return applyRasterCalcAB_ABNull(input_a,input_b,output,expr,nodata_val=nodata_val,
                 out_type=out_type,context=context,feedback=feedback)
@@ -1085,6 +1796,187 @@ def applyRasterCalcMax(input_a,input_b,output,
     return applyRasterCalcAB_ABNull(input_a,input_b,output,expr,nodata_val=nodata_val,
                 out_type=out_type,context=context,feedback=feedback)
 
+# Lazy raster mode (see lazy_raster_flag)
+#
+# Pixel-wise wrappers (applyRasterCalc*, applyReclassifyByTable) return a
+# LazyRaster node when output is temporary. Chained nodes are fused and
+# evaluated in a single block-wise NumPy pass when materialized, that is when
+# a real output path is given, when a node is passed to applyProcessingAlg
+# or when it is used as a path (str() / os.fspath()).
+# Warp wrappers (applyWarpReproject, clipRasterFromVector) return a warped
+# VRT file which is read through by next steps.
+
+class LazyRaster:
+
+    def __init__(self,op,inputs,params):
+        self.op = op
+        self.inputs = inputs
+        self.params = params
+        self.path = None
+        self.leaves = []
+        for input in inputs.values():
+            leaves = input.leaves if isinstance(input,LazyRaster) else [input]
+            for leaf in leaves:
+                if leaf not in self.leaves:
+                    self.leaves.append(leaf)
+
+    def __str__(self):
+        return self.materialize()
+
+    def __fspath__(self):
+        return self.materialize()
+
+    def __repr__(self):
+        return "LazyRaster(" + str(self.op) + "," + str(self.params) + ")"
+
+    # Computes block of node over window (x_off,y_off,x_size,y_size) from
+    # leaf bands. Returns values (of output type) and NoData mask.
+    def evalBlock(self,bands,window):
+        shape = (window[3],window[2])
+        arrays, masks = {}, {}
+        for name, input in self.inputs.items():
+            if isinstance(input,LazyRaster):
+                arrays[name], masks[name] = input.evalBlock(bands,window)
+            else:
+                band = bands[input]
+                array = band.ReadAsArray(*window)
+                in_nodata = band.GetNoDataValue()
+                arrays[name] = array
+                masks[name] = (np.zeros(shape,dtype=bool) if in_nodata is None
+                    else qgsUtils.noDataMask(array,in_nodata))
+        nodata = float(self.params['nodata'])
+        if self.op == 'calc':
+            code = compile(self.params['expr'],'<raster calc>','eval')
+            if self.params['merge_nodata']:
+                a_nd, b_nd = masks['A'], masks['B']
+                ma_arrays = { name : np.ma.masked_array(arrays[name],mask=masks[name])
+                    for name in arrays }
+                res = qgsUtils.evalCalcBlock(code,ma_arrays,shape)
+                res = np.where(a_nd,arrays['B'],np.where(b_nd,arrays['A'],res))
+                mask = a_nd & b_nd
+            else:
+                res = qgsUtils.evalCalcBlock(code,arrays,shape)
+                mask = np.zeros(shape,dtype=bool)
+                for m in masks.values():
+                    mask |= m
+        elif self.op == 'reclass':
+            res, missing = qgsUtils.reclassifyArray(arrays['A'],self.params['table'],
+                boundaries_mode=self.params['boundaries_mode'])
+            mask = masks['A']
+            if self.params['nodata_missing']:
+                mask = mask | missing
+            else:
+                res = np.where(missing,arrays['A'],res)
+        else:
+            utils.internal_error("Unexpected lazy raster operation " + str(self.op))
+        dtype = GDAL_CALC_NUMPY_TYPES[self.params['type_name']]
+        res = qgsUtils.castLikeGdal(np.where(mask,nodata,res),dtype)
+        # Values equal to NoData would be read back as NoData from a file
+        mask = mask | qgsUtils.noDataMask(res,qgsUtils.castLikeGdal(np.array(nodata),dtype))
+        return res, mask
+
+    # Computes node values and writes them to 'out_path' (temporary file if None).
+    # Temporary result is kept so that node is only computed once.
+    def materialize(self,out_path=None,feedback=None):
+        if out_path is None and self.path is not None:
+            return self.path
+        path = out_path if out_path else QgsProcessingUtils.generateTempFilename('OUTPUT.tif')
+        if feedback:
+            feedback.pushInfo("Materializing " + repr(self) + " to " + str(path))
+        start_time = time.time()
+        rasters = [ gdal.Open(leaf) for leaf in self.leaves ]
+        bands = { leaf : raster.GetRasterBand(1) for leaf, raster in zip(self.leaves,rasters) }
+        out_ds = qgsUtils.createRasterLike(rasters[0],path,
+            gdal.GetDataTypeByName(self.params['type_name']),
+            nodata=self.params['nodata'],copt=GTIFF_COPT)
+        out_band = out_ds.GetRasterBand(1)
+        windows = list(qgsUtils.iterRasterWindows(bands[self.leaves[0]]))
+        for cpt, window in enumerate(windows):
+            if feedback and feedback.isCanceled():
+                break
+            res, mask = self.evalBlock(bands,window)
+            out_band.WriteArray(res,window[0],window[1])
+            if feedback:
+                feedback.setProgress(100 * (cpt + 1) / len(windows))
+        out_band.FlushCache()
+        out_band = out_ds = None # Close writing
+        if feedback:
+            feedback.pushInfo("Lazy raster materialized in "
+                + str(time.time() - start_time) + " seconds")
+        if out_path is None:
+            self.path = path
+        return path
+
+# Returns input path (or LazyRaster node) usable in lazy chains, None if not a file
+def lazyInput(input):
+    if isinstance(input,LazyRaster):
+        return input
+    return rasterInputPath(input)
+
+# Returns value with LazyRaster nodes (possibly in lists) replaced by their path
+def materializeLazy(value,feedback=None):
+    if isinstance(value,LazyRaster):
+        return value.materialize(feedback=feedback)
+    if isinstance(value,list):
+        return [ materializeLazy(v,feedback=feedback) for v in value ]
+    return value
+
+# Builds lazy pixel-wise node 'op' if lazy mode applies (temporary output with
+# lazy_raster_flag set, or lazy input). Returns LazyRaster node for temporary
+# output, output path once materialized otherwise, and None if node cannot be
+# built (non-file inputs, inputs of different dimensions), in which case
+# caller performs eager computation.
+def applyLazyPixelOp(op,inputs,output,params,feedback=None):
+    has_lazy_input = any(isinstance(i,LazyRaster) for i in inputs.values())
+    if not (has_lazy_input or (lazy_raster_flag and output == tmpOutput)):
+        return None
+    lazy_inputs = {}
+    for name, input in inputs.items():
+        lazy_input = lazyInput(input)
+        if lazy_input is None:
+            return None
+        lazy_inputs[name] = lazy_input
+    node = LazyRaster(op,lazy_inputs,params)
+    dims = set()
+    for leaf in node.leaves:
+        raster = gdal.Open(leaf)
+        if not raster:
+            return None
+        dims.add((raster.RasterXSize,raster.RasterYSize))
+    if len(dims) != 1:
+        return None
+    if output == tmpOutput:
+        return node
+    if not isinstance(output,str) or os.path.splitext(output)[1].lower() not in ['.tif','.tiff']:
+        return None
+    return node.materialize(out_path=output,feedback=feedback)
+
+# Returns gdal.Warp SRS string from QgsCoordinateReferenceSystem or string
+def lazyWarpCrs(crs):
+    if isinstance(crs,QgsCoordinateReferenceSystem):
+        return crs.authid() if crs.authid() else crs.toWkt()
+    return str(crs)
+
+# Builds warped VRT from 'input' with gdal.Warp options 'warp_opts' if lazy
+# mode applies (temporary output with lazy_raster_flag set).
+# Returns VRT path, or None if call is left to processing algorithm.
+def applyLazyWarp(input,output,warp_opts,feedback=None):
+    if not (lazy_raster_flag and output == tmpOutput):
+        return None
+    src = lazyInput(input)
+    if src is None:
+        return None
+    src = materializeLazy(src,feedback=feedback)
+    out_path = QgsProcessingUtils.generateTempFilename('OUTPUT.vrt')
+    opts = { k : v for k, v in warp_opts.items() if v is not None }
+    res = gdal.Warp(out_path,src,format='VRT',**opts)
+    if res is None:
+        return None
+    res = None # Close writing
+    if feedback:
+        feedback.pushInfo("Warp deferred to virtual raster " + str(out_path))
+    return out_path
+
 def applyProximity(input,output,classes='',band=1,units=0,context=None,feedback=None):
     # { 'BAND' : 1, 'DATA_TYPE' : 5, 'EXTRA' : '', 'INPUT' : 'E:/IRSTEA/IMBE_Verdon/data/clc_lines_raster.tif', 'MAX_DISTANCE' : 0, 'NODATA' : 0, 'OPTIONS' : '', 'OUTPUT' : 'TEMPORARY_OUTPUT', 'REPLACE' : 0, 'UNITS' : 0, 'VALUES' : '1,2,3,4,5' }
     parameters = {
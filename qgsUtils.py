@@ -23,20 +23,22 @@
     Useful functions to perform base operation on QGIS interface and data types.
 """
 
-import os, shutil
+import collections, concurrent.futures, contextlib, os, shutil, threading
 from pathlib import Path
 import numpy as np
 
 try:
-    from osgeo import gdal
+    from osgeo import gdal, ogr
 except ImportError:
-    import gdal
+    import gdal, ogr
 
 import qgis
+import qgis.utils
 from qgis.gui import *
 from qgis.core import *
-from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.PyQt.QtCore import QCoreApplication, QThread, QVariant
 from qgis.PyQt.QtWidgets import QFileDialog
+from qgis.PyQt import sip
 
 from . import utils
 from .qt_compatibility import *
@@ -73,6 +75,7 @@ def isRasterLayer(layer):
 
 def removeFolder(path):
     if os.path.isdir(path):
+        utils.releaseFile(path)
         shutil.rmtree(path)
 
 # Delete raster file and associated xml file
@@ -82,6 +85,7 @@ def removeRaster(path):
     utils.removeFile(path)
     aux_name = path + ".aux.xml"
     utils.removeFile(aux_name)
+    raster_stats_cache.invalidate(path)
 
 def removeVectorLayer(path):
     if isLayerLoaded(path):
@@ -110,29 +114,229 @@ def getVectorFilters():
 def getRasterFilters():
     return QgsProviderRegistry.instance().fileRasterFilters()
 
-def getLayerByFilename(fname):
-    map_layers = QgsProject.instance().mapLayers().values()
-    fname_parts = Path(fname.lower()).parts
-    utils.debug("fname_parts : " + str(fname_parts))
-    for layer in map_layers:
-        # utils.debug("layer : " + str(layer.name()))
-        layer_path = pathOfLayer(layer)
-        path_parts = Path(layer_path.lower()).parts
-        # utils.debug("path_parts : " + str(path_parts))
-        if fname_parts == path_parts:
-            return layer
-    else:
+# Returns key identifying layer path (case and separators insensitive)
+def layerPathKey(fname):
+    return Path(str(fname).lower()).parts
+
+# Index of project layers by path and source, updated from QgsProject
+# layersAdded/layersRemoved signals (connected on first lookup) and from
+# layers dataSourceChanged signal.
+# Several layers may share a path, first loaded one is returned.
+class LayerRegistry:
+
+    def __init__(self):
+        self.project = None
+        self.lock = threading.RLock()
+        # Ids of layers whose dataSourceChanged signal is connected
+        self.connected_ids = set()
+        self.clearIndex()
+
+    def clearIndex(self):
+        self.by_path = {}
+        self.by_source = {}
+        self.layer_keys = {}
+
+    def indexLayer(self,layer):
+        lid = layer.id()
+        path_key, source = layerPathKey(pathOfLayer(layer)), layer.source()
+        self.layer_keys[lid] = (path_key, source)
+        self.by_path.setdefault(path_key,[]).append(lid)
+        self.by_source.setdefault(source,[]).append(lid)
+        if lid not in self.connected_ids:
+            self.connected_ids.add(lid)
+            layer.dataSourceChanged.connect(lambda lid=lid : self.reindexLayer(lid))
+
+    # Updates index entries of layer 'lid' after its data source changed
+    def reindexLayer(self,lid):
+        with self.lock:
+            self.unindexLayer(lid)
+            layer = self.project.mapLayer(lid) if self.project is not None else None
+            if layer is not None:
+                self.indexLayer(layer)
+
+    def unindexLayer(self,lid):
+        if lid not in self.layer_keys:
+            return
+        path_key, source = self.layer_keys.pop(lid)
+        for index, key in [(self.by_path, path_key), (self.by_source, source)]:
+            ids = index.get(key,[])
+            if lid in ids:
+                ids.remove(lid)
+            if not ids:
+                index.pop(key,None)
+
+    def layersAdded(self,layers):
+        with self.lock:
+            for layer in layers:
+                self.indexLayer(layer)
+
+    def layersRemoved(self,layer_ids):
+        with self.lock:
+            for lid in layer_ids:
+                self.unindexLayer(lid)
+                self.connected_ids.discard(lid)
+
+    # Rebuilds index from project layers
+    def rebuild(self):
+        with self.lock:
+            self.clearIndex()
+            for layer in self.project.mapLayers().values():
+                self.indexLayer(layer)
+
+    # Connects to current project signals and indexes its layers
+    def checkProject(self):
+        project = QgsProject.instance()
+        with self.lock:
+            if self.project is project:
+                return project
+            if self.project is not None:
+                try:
+                    self.project.layersAdded.disconnect(self.layersAdded)
+                    self.project.layersRemoved.disconnect(self.layersRemoved)
+                except (TypeError, RuntimeError):
+                    pass
+            self.project = project
+            self.connected_ids = set()
+            project.layersAdded.connect(self.layersAdded)
+            project.layersRemoved.connect(self.layersRemoved)
+            self.rebuild()
+            return project
+
+    # Returns first layer indexed with 'key' in 'index' (by_path or by_source)
+    # such that keyFunc(layer) == key, index is rebuilt if outdated
+    def lookup(self,index_name,key,keyFunc):
+        project = self.checkProject()
+        for retry in [False, True]:
+            with self.lock:
+                ids = list(getattr(self,index_name).get(key,[]))
+            for lid in ids:
+                layer = project.mapLayer(lid)
+                if layer is not None and keyFunc(layer) == key:
+                    return layer
+            if not ids or retry:
+                return None
+            # Layer removed or data source changed since indexation
+            self.rebuild()
         return None
+
+    def getLayerByFilename(self,fname):
+        return self.lookup('by_path',layerPathKey(fname),
+            lambda l : layerPathKey(pathOfLayer(l)))
+
+    def getLayerBySource(self,source):
+        return self.lookup('by_source',source,lambda l : l.source())
+
+layer_registry = LayerRegistry()
+
+def getLayerByFilename(fname):
+    return layer_registry.getLayerByFilename(fname)
+
 def getLayerBySource(source):
-    map_layers = QgsProject.instance().mapLayers().values()
-    for layer in map_layers:
-        match = layer.source() == source
-        # self.feedback.pushDebugInfo("match {} {} = {}".format(
-        #     layer.source(),source,match))
-        if match:
+    return layer_registry.getLayerBySource(source)
+
+# Bounded LRU cache of layers opened outside of project, keyed by normalized
+# path. Entries are invalidated when dataset files modification time changes
+# and when their files are written or deleted (see utils.releaseFile).
+# Cached layers are never handed out : callers get clones (with their own
+# style, subset string, selection, ...) created in the thread owning
+# cached layer.
+class OpenedLayersCache:
+
+    def __init__(self,max_entries=32):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def pathKey(fname):
+        return os.path.normcase(os.path.abspath(str(fname)))
+
+    @staticmethod
+    def datasetMTime(fname):
+        files = utils.datasetFiles(str(fname))
+        return max(os.path.getmtime(f) for f in files) if files else None
+
+    @staticmethod
+    def cloneLayer(layer):
+        res = layer.clone()
+        if isinstance(layer,QgsVectorLayer):
+            res.dataProvider().setEncoding(layer.dataProvider().encoding())
+        return res
+
+    # Returns cached layer of given class (any layer if None) if valid, None otherwise
+    def lookup(self,fname,layer_class=None):
+        key = self.pathKey(fname)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            mtime, layer = self.entries[key]
+            if sip.isdeleted(layer):
+                del self.entries[key]
+                return None
+            if layer.thread() != QThread.currentThread():
+                return None
+            if (mtime != self.datasetMTime(fname)
+                    or (layer_class is not None and not isinstance(layer,layer_class))):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return layer
+
+    # Returns clone of cached layer of given class (any layer if None) or None
+    def get(self,fname,layer_class=None):
+        with self.lock:
+            layer = self.lookup(fname,layer_class)
+            return None if layer is None else self.cloneLayer(layer)
+
+    # Removes layer from cache and returns it (e.g. before adding it to project)
+    def pop(self,fname,layer_class=None):
+        with self.lock:
+            layer = self.lookup(fname,layer_class)
+            if layer is not None:
+                self.invalidate(fname)
             return layer
+
+    # Caches a clone of 'layer', which is left to caller
+    def put(self,fname,layer):
+        key = self.pathKey(fname)
+        with self.lock:
+            self.entries[key] = (self.datasetMTime(fname), self.cloneLayer(layer))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drops layers of 'fname' (or of files in folder 'fname'), their
+    # provider handles being closed once layers are deleted
+    def invalidate(self,fname):
+        key = self.pathKey(fname)
+        stem = os.path.splitext(key)[0]
+        with self.lock:
+            for k in list(self.entries):
+                if (k == key or k.startswith(key + os.sep)
+                        or (key.endswith(tuple(utils.SHAPEFILE_SIDECARS))
+                            and os.path.splitext(k)[0] == stem)):
+                    del self.entries[k]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+opened_layers_cache = OpenedLayersCache()
+utils.file_release_hooks.append(opened_layers_cache.invalidate)
+
+# Returns layer opened outside of project from cache or with 'openFunc'
+# (returning None if layer cannot be opened). If 'loadProject' is True,
+# layer is removed from cache since it is to be owned by project.
+def openCachedLayer(fname,openFunc,layer_class=None,loadProject=False):
+    if loadProject:
+        layer = opened_layers_cache.pop(fname,layer_class)
     else:
-        return None
+        layer = opened_layers_cache.get(fname,layer_class)
+    if layer is None:
+        layer = openFunc(fname)
+        if layer is not None and layer.isValid() and not loadProject:
+            opened_layers_cache.put(fname,layer)
+    return layer
 
 def isLayerLoaded(fname):
     return (getLayerByFilename(fname) != None)
@@ -149,18 +353,117 @@ def normalizeEncoding(layer):
     elif extension == ".gpkg":
         layer.dataProvider().setEncoding('UTF-8')
 
-def loadLayerInQGIS(layer,groupName=None):
-    if groupName:
-        root = QgsProject.instance().layerTreeRoot()
+# Layer tree groups by name : { name : QgsLayerTreeGroup }.
+# Index is cleared whenever a node is removed or renamed in layer tree or
+# when project is cleared, so that indexed nodes are never dereferenced
+# after being deleted.
+layer_tree_groups = {}
+layer_tree_groups_root = None
+
+def clearGroupsIndex(*args):
+    layer_tree_groups.clear()
+
+# Connects groups index to signals of current project layer tree
+def checkGroupsIndex():
+    global layer_tree_groups_root
+    project = QgsProject.instance()
+    root = project.layerTreeRoot()
+    if root is not layer_tree_groups_root:
+        clearGroupsIndex()
+        root.willRemoveChildren.connect(clearGroupsIndex)
+        root.nameChanged.connect(clearGroupsIndex)
+        project.cleared.connect(clearGroupsIndex)
+        layer_tree_groups_root = root
+    return root
+
+# Returns group 'groupName' of project layer tree (created at root if needed)
+def getOrCreateGroup(groupName):
+    root = checkGroupsIndex()
+    group = layer_tree_groups.get(groupName,None)
+    if group is None:
         group = root.findGroup(groupName)
         if not group:
             group = root.addGroup(groupName)
+        layer_tree_groups[groupName] = group
+    return group
+
+# Freezes map canvas (if any) to render it once at the end of context
+@contextlib.contextmanager
+def frozenCanvas():
+    iface = getattr(qgis.utils,'iface',None)
+    canvas = iface.mapCanvas() if iface is not None else None
+    if canvas is None or canvas.isFrozen():
+        yield
+        return
+    canvas.freeze(True)
+    try:
+        yield
+    finally:
+        canvas.freeze(False)
+        canvas.refresh()
+
+# Collects layer tree operations and applies them at once on exit :
+# one removeMapLayers call, one addMapLayers call per kind (grouped or not),
+# one insertion per group, map canvas being frozen meanwhile.
+# Layer tree signals are kept so that layer tree views stay consistent.
+class LayerTreeBatch:
+
+    def __init__(self):
+        self.added = collections.OrderedDict()
+        self.removed_layers = []
+        self.removed_groups = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.apply()
+        return False
+
+    def addLayer(self,layer,groupName=None):
+        self.added.setdefault(groupName,[]).append(layer)
+
+    def removeLayer(self,layer):
+        self.removed_layers.append(layer.id())
+
+    def removeGroups(self,groupName):
+        self.removed_groups.append(groupName)
+
+    def apply(self):
+        project = QgsProject.instance()
+        with frozenCanvas():
+            if self.removed_layers:
+                project.removeMapLayers(self.removed_layers)
+            for groupName in self.removed_groups:
+                removeGroupsNodes(groupName)
+            grouped = [ l for g, layers in self.added.items() if g for l in layers ]
+            if grouped:
+                project.addMapLayers(grouped,False)
+            for groupName, layers in self.added.items():
+                if groupName:
+                    group = getOrCreateGroup(groupName)
+                    group.insertChildNodes(-1,[ QgsLayerTreeLayer(l) for l in layers ])
+            if self.added.get(None,None):
+                project.addMapLayers(self.added[None],True)
+        self.added.clear()
+        self.removed_layers, self.removed_groups = [], []
+
+def loadLayerInQGIS(layer,groupName=None):
+    if groupName:
+        group = getOrCreateGroup(groupName)
         QgsProject.instance().addMapLayer(layer,False)
         group.addLayer(layer)
         # group.insertChildNode(0,layer)
     else:
         QgsProject.instance().addMapLayer(layer,True)
 
+# Adds layers to QGIS project at once (see LayerTreeBatch)
+def loadLayersInQGIS(layers,groupName=None):
+    with LayerTreeBatch() as batch:
+        for layer in layers:
+            batch.addLayer(layer,groupName=groupName)
+
 # Opens vector layer from path.
 # If loadProject is True, layer is added to QGIS project
 def loadVectorLayer(fname,loadProject=False,normalize=False,groupName=None,
@@ -169,7 +472,9 @@ def loadVectorLayer(fname,loadProject=False,normalize=False,groupName=None,
     utils.checkFileExists(fname)
     if isLayerLoaded(fname):
        return getLayerByFilename(fname)
-    layer = QgsVectorLayer(fname, layerNameOfPath(fname), "ogr")
+    layer = openCachedLayer(fname,
+        lambda p : QgsVectorLayer(p, layerNameOfPath(p), "ogr"),
+        layer_class=QgsVectorLayer,loadProject=loadProject)
     if not layer:
         utils.user_error("Could not load vector layer '" + fname + "'")
     if checkValidity and not layer.isValid():
@@ -187,7 +492,9 @@ def loadRasterLayer(fname,loadProject=False,groupName=None):
     utils.checkFileExists(fname)
     if isLayerLoaded(fname):
         return getLayerByFilename(fname)
-    rlayer = QgsRasterLayer(fname, layerNameOfPath(fname))
+    rlayer = openCachedLayer(fname,
+        lambda p : QgsRasterLayer(p, layerNameOfPath(p)),
+        layer_class=QgsRasterLayer,loadProject=loadProject)
     if not rlayer.isValid():
         utils.user_error("Invalid raster layer '" + fname + "'")
     if loadProject:
@@ -226,13 +533,64 @@ def loadRasterLayerNoError(fname):
         return None
     return layer
 
+# Extensions of single type formats (other formats are probed with GDAL)
+VECTOR_EXTENSIONS = ['.shp', '.dbf', '.geojson', '.kml', '.gml', '.csv',
+    '.tab', '.mif', '.fgb']
+RASTER_EXTENSIONS = ['.tif', '.tiff', '.vrt', '.asc', '.img', '.jp2',
+    '.sdat', '.bil', '.nc']
+
+# Layer type detected from path : { normalized path : (mtime, type) }
+layer_types_cache = {}
+
+# Returns 'Vector' or 'Raster' according to file extension or to a cheap
+# GDAL probe (without opening a QGIS provider), None if type is unknown
+def layerTypeOfPath(fname):
+    fname = str(fname)
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in VECTOR_EXTENSIONS:
+        return 'Vector'
+    if ext in RASTER_EXTENSIONS:
+        return 'Raster'
+    key = os.path.normcase(os.path.abspath(fname))
+    mtime = os.path.getmtime(fname) if os.path.exists(fname) else None
+    if key in layer_types_cache and layer_types_cache[key][0] == mtime:
+        return layer_types_cache[key][1]
+    type = None
+    try:
+        ds = gdal.OpenEx(fname,gdal.OF_VECTOR)
+        if ds is not None and ds.GetLayerCount() > 0:
+            type = 'Vector'
+        elif gdal.IdentifyDriverEx(fname,gdal.OF_RASTER) is not None:
+            type = 'Raster'
+        ds = None
+    except RuntimeError:
+        pass
+    if type is not None:
+        layer_types_cache[key] = (mtime, type)
+    return type
+
+# Opens layer from path with provider matching its detected type
+# (see layerTypeOfPath) and returns (layer, type), or (None, None)
+def openLayerGetType(fname):
+    type = layerTypeOfPath(fname)
+    openers = [(loadVectorLayerNoError, 'Vector'), (loadRasterLayerNoError, 'Raster')]
+    if type == 'Raster':
+        openers.reverse()
+    for openFunc, open_type in openers:
+        layer = openFunc(fname)
+        if layer is not None:
+            return (layer, open_type)
+        if type is not None:
+            # Detected type may be wrong, other type is still tried
+            utils.debug("Could not open " + str(fname) + " as " + type)
+    return (None, None)
+
 def loadLayer(fname,loadProject=False,groupName=None):
     utils.debug("loadLayer " + str(fname))
     if isLayerLoaded(fname):
         return getLayerByFilename(fname)
-    layer = loadVectorLayerNoError(fname)
-    if layer is None:
-        layer = loadRasterLayerNoError(fname)
+    layer = openCachedLayer(fname,lambda p : openLayerGetType(p)[0],
+        loadProject=loadProject)
     if layer is None:
         utils.user_error("Could not load layer '" + fname + "'")
     if loadProject:
@@ -263,17 +621,58 @@ def loadLayer(fname,loadProject=False,groupName=None):
 
 def loadLayerGetType(fname,loadProject=False,groupName=None):
     utils.debug("loadLayerGetType " + str(fname))
-    layer = loadVectorLayerNoError(fname)
-    type = 'Vector'
-    if layer is None:
-        layer = loadRasterLayerNoError(fname)
-        type = 'Raster'
+    layer = openCachedLayer(fname,lambda p : openLayerGetType(p)[0],
+        loadProject=loadProject)
+    type = 'Vector' if layer is not None and isVectorLayer(layer) else 'Raster'
     if layer is None:
         utils.user_error("Could not load layer '" + fname + "'")
     if loadProject:
         loadLayerInQGIS(layer,groupName=groupName)
     return (layer, type)
 
+# Opens layers from paths concurrently with 'nb_workers' threads (provider
+# opening being the costly part) and returns them in paths order.
+# Layers already loaded in project are reused. If loadProject is True,
+# opened layers are added to project (and group) at once.
+def loadLayers(paths,loadProject=False,groupName=None,nb_workers=None):
+    utils.debug("loadLayers " + str(paths))
+    main_thread = QCoreApplication.instance().thread()
+    def openLayer(p):
+        layer, type = openLayerGetType(p)
+        # Layers created in worker threads must belong to main thread
+        if layer is not None:
+            layer.moveToThread(main_thread)
+        return layer
+    res, to_open, new_layers = {}, [], []
+    for p in paths:
+        if p in res or p in to_open:
+            continue
+        utils.checkFileExists(p)
+        layer = getLayerByFilename(p)
+        if layer is None:
+            layer = (opened_layers_cache.pop(p) if loadProject
+                else opened_layers_cache.get(p))
+            if layer is not None:
+                new_layers.append(layer)
+        if layer is None:
+            to_open.append(p)
+        else:
+            res[p] = layer
+    if to_open:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            opened = list(executor.map(openLayer,to_open))
+        failed = [ p for p, l in zip(to_open,opened) if l is None ]
+        if failed:
+            utils.user_error("Could not load layers " + str(failed))
+        for p, layer in zip(to_open,opened):
+            res[p] = layer
+            new_layers.append(layer)
+            if not loadProject:
+                opened_layers_cache.put(p,layer)
+    if loadProject:
+        loadLayersInQGIS(new_layers,groupName=groupName)
+    return [ res[p] for p in paths ]
+
 # Retrieve layer loaded in QGIS project from name
 def getLoadedLayerByName(name):
     utils.debug("Layers = " + str([l.name() for l in QgsProject.instance().mapLayers().values()]))
@@ -312,18 +711,38 @@ def removeGroupR(root,groupName):
             else:
                 removeGroupR(c,groupName)
 
-def removeGroups(groupName):
+# Removes all groups named 'groupName' (groups are first collected
+# and then removed, without canvas refresh between removals)
+def removeGroupsNodes(groupName):
     root = QgsProject.instance().layerTreeRoot()
-    removeGroupR(root,groupName)
+    to_remove, stack = [], [root]
+    while stack:
+        node = stack.pop()
+        for c in node.children():
+            if c.nodeType() ==  QgsLayerTreeNode.NodeGroup:
+                if c.name() == groupName:
+                    to_remove.append((node, c))
+                else:
+                    stack.append(c)
+    for parent, group in to_remove:
+        parent.removeChildNode(group)
+
+def removeGroups(groupName):
+    with frozenCanvas():
+        removeGroupsNodes(groupName)
 
 # Find all groups
 def findGroupsAll(root=None):
     if root is None:
         root = QgsProject.instance().layerTreeRoot()
-    groups = root.findGroups()
-    for c in root.children():
-        if c.nodeType() ==  QgsLayerTreeNode.NodeGroup:
-            groups += findGroupsAll(c)
+    groups = []
+    def collectGroups(node):
+        children = [ c for c in node.children()
+            if c.nodeType() ==  QgsLayerTreeNode.NodeGroup ]
+        groups.extend(children)
+        for c in children:
+            collectGroups(c)
+    collectGroups(root)
     return groups
 
 
@@ -419,17 +838,72 @@ def checkLayersCompatible(l1,l2):
                     + "' not compatible with geometry '" + str(geomType2)
                     + "' of layer " + l2.name())
 
-def createOrUpdateField(in_layer,func,out_field):
+# Default number of features processed at once by createOrUpdateField
+ATTRIBUTES_CHUNK_SIZE = 10000
+
+# Returns Python value to store in attribute (NaN values are stored as NULL)
+def attributeValue(v):
+    if isinstance(v,np.generic):
+        v = v.item()
+    if isinstance(v,float) and np.isnan(v):
+        return NULL
+    return v
+
+# Sets field 'out_field' (created as Double if needed) to func(f) for each
+# feature f. Values are computed by chunks of 'chunk_size' features and
+# written in one batch with dataProvider().changeAttributeValues, skipping
+# edit buffer and undo stack.
+# If 'fields' is given, only these fields are read (without geometries) and
+# 'func' is called once per chunk on a dictionary { fieldname : NumPy array }
+# (built as in iterLayerColumns, see columnArray for NULL values)
+# and returns the array of values (e.g. lambda c : c["area"] / c["length"]).
+# Edit buffer is still used if layer is in edit mode or if its provider
+# cannot change attribute values.
+def createOrUpdateField(in_layer,func,out_field,fields=None,
+        chunk_size=ATTRIBUTES_CHUNK_SIZE):
+    pr = in_layer.dataProvider()
     if out_field not in in_layer.fields().names():
         field = QgsField(out_field, QVariant.Double)
-        in_layer.dataProvider().addAttributes([field])
+        pr.addAttributes([field])
         in_layer.updateFields()
-
-    in_layer.startEditing()
-    for f in in_layer.getFeatures():
-        f[out_field] = func(f)
-        in_layer.updateFeature(f)
-    in_layer.commitChanges()
+    request = QgsFeatureRequest()
+    if fields is not None:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(fields,in_layer.fields())
+    if fields is not None:
+        field_types = { name : in_layer.fields().field(name).type() for name in fields }
+    changes = {}
+    def addChanges(chunk):
+        if fields is None:
+            values = [ func(f) for f in chunk ]
+        else:
+            columns = { name : columnArray([ f[name] for f in chunk ],field_types[name])
+                for name in fields }
+            values = np.broadcast_to(func(columns),(len(chunk),))
+        for f, v in zip(chunk,values):
+            changes[f.id()] = attributeValue(v)
+    bulk_flag = (not in_layer.isEditable()
+        and pr.capabilities() & QgsVectorDataProvider.ChangeAttributeValues)
+    if not bulk_flag:
+        in_layer.startEditing()
+    field_idx = pr.fieldNameIndex(out_field) if bulk_flag else in_layer.fields().indexOf(out_field)
+    chunk = []
+    for f in in_layer.getFeatures(request):
+        chunk.append(f)
+        if len(chunk) >= chunk_size:
+            addChanges(chunk)
+            chunk = []
+    if chunk:
+        addChanges(chunk)
+    if bulk_flag:
+        if not pr.changeAttributeValues({ fid : { field_idx : v } for fid, v in changes.items() }):
+            utils.internal_error("Could not update field '" + str(out_field)
+                + "' of layer " + str(in_layer.name()))
+        in_layer.triggerRepaint()
+    else:
+        for fid, v in changes.items():
+            in_layer.changeAttributeValue(fid,field_idx,v)
+        in_layer.commitChanges()
 
 
 # Initialize new layer from existing one, importing CRS and geometry
@@ -449,6 +923,7 @@ def createLayerFromExisting(inLayer,outName,geomType=None,crs=None):
 # Writes file from existing QgsMapLayer
 def writeShapefile(layer,outfname):
     utils.debug("[writeShapefile] " + outfname + " from " + str(layer))
+    utils.releaseFile(outfname)
     if os.path.isfile(outfname):
         os.remove(outfname)
     (error, error_msg) = QgsVectorFileWriter.writeAsVectorFormat(layer,outfname,'utf-8',destCRS=layer.sourceCrs(),driverName='ESRI Shapefile')
@@ -457,9 +932,47 @@ def writeShapefile(layer,outfname):
     else:
         utils.user_error("Unable to create shapefile '" + outfname + "' : " + str(error_msg))
 
+# Default number of features written at once by addFeaturesByBatch
+FEATURES_BATCH_SIZE = 10000
+
+# Creates vector file 'outfname' (format from extension, GeoPackage by default)
+# with given fields, geometry type and CRS, and returns its writer (feature sink).
+# File is closed when writer is deleted.
+def createVectorWriter(outfname,fields,wkb_type,crs):
+    utils.releaseFile(outfname)
+    if os.path.isfile(outfname):
+        os.remove(outfname)
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    ext = os.path.splitext(outfname)[1]
+    options.driverName = QgsVectorFileWriter.driverForExtension(ext) if ext else 'GPKG'
+    options.fileEncoding = 'utf-8'
+    writer = QgsVectorFileWriter.create(outfname,fields,wkb_type,crs,
+        QgsProject.instance().transformContext(),options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        utils.user_error("Unable to create file '" + outfname + "' : " + str(writer.errorMessage()))
+    return writer
+
+# Adds features of iterable 'feats' to sink (writer or data provider)
+# with one call per batch of 'batch_size' features
+def addFeaturesByBatch(sink,feats,batch_size=FEATURES_BATCH_SIZE):
+    def addBatch(batch):
+        # Providers return (success, features), some sinks only success
+        res = sink.addFeatures(batch)
+        if not (res[0] if isinstance(res,tuple) else res):
+            utils.internal_error("addFeatures failed")
+    batch = []
+    for f in feats:
+        batch.append(f)
+        if len(batch) >= batch_size:
+            addBatch(batch)
+            batch = []
+    if batch:
+        addBatch(batch)
+
 # Writes file from existing QgsMapLayer
 def writeVectorLayer(layer,outfname,attributes=[]):
     utils.debug("[writeVectorLayer] " + outfname + " from " + str(layer))
+    utils.releaseFile(outfname)
     if os.path.isfile(outfname):
         os.remove(outfname)
     (error, error_msg) = QgsVectorFileWriter.writeAsVectorFormat(layer,outfname,
@@ -495,25 +1008,153 @@ def transformBoundingBox(in_rect,in_crs,out_crs):
     out_rect = transformator.transformBoundingBox(in_rect)
     return out_rect
 
+# Raises error if one of 'fieldnames' is not a field of layer
+def checkLayerFields(layer,fieldnames):
+    layer_fieldnames = layer.fields().names()
+    for fieldname in fieldnames:
+        if fieldname not in layer_fieldnames:
+            utils.internal_error("No field named '" + fieldname + "' in layer " + pathOfLayer(layer))
+
+# Returns request fetching only 'fieldnames' values, without geometries
+def attributesRequest(layer,fieldnames):
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(fieldnames,layer.fields())
+    return request
+
+# Feature id column name in columns returned by iterLayerColumns
+FID_COLUMN = "fid"
+# Geometry columns : WKB bytes ('wkb') or centroids coordinates ('x', 'y')
+GEOM_WKB = "wkb"
+GEOM_CENTROID = "centroid"
+
+# Returns NumPy array of attribute values of given field type : numeric
+# fields give int64 or float64 arrays (NULL values as NaN), other fields
+# give object arrays (NULL values as None)
+def columnArray(values,field_type):
+    if typeIsNumeric(field_type):
+        if typeIsInteger(field_type) and all(v != NULL for v in values):
+            return np.array(values,dtype=np.int64)
+        return np.array([ np.nan if v == NULL else v for v in values ],dtype=np.float64)
+    res = np.empty(len(values),dtype=object)
+    res[:] = [ None if v == NULL else v for v in values ]
+    return res
+
+# Iterates over features of layer by chunks of 'chunk_size' and yields
+# dictionaries { column : NumPy array } containing feature ids (FID_COLUMN),
+# values of 'fieldnames' (all fields if None) and, if 'geometry' is GEOM_WKB
+# or GEOM_CENTROID, geometries as WKB bytes or centroids coordinates.
+# Only needed attributes are fetched, geometries are skipped unless asked.
+# Optional 'request' (e.g. with a filter expression) restricts features.
+def iterLayerColumns(layer,fieldnames=None,geometry=None,
+        chunk_size=FEATURES_BATCH_SIZE,request=None):
+    if fieldnames is None:
+        fieldnames = layer.fields().names()
+    checkLayerFields(layer,fieldnames)
+    if geometry not in [None, GEOM_WKB, GEOM_CENTROID]:
+        utils.internal_error("Unexpected geometry column type " + str(geometry))
+    request = QgsFeatureRequest(request) if request else QgsFeatureRequest()
+    if geometry is None:
+        request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(fieldnames,layer.fields())
+    fields = layer.fields()
+    idxs = [ fields.indexOf(name) for name in fieldnames ]
+    types = [ fields.at(idx).type() for idx in idxs ]
+    def mkColumns(chunk):
+        columns = { FID_COLUMN : np.array([ f.id() for f in chunk ],dtype=np.int64) }
+        attrs = [ f.attributes() for f in chunk ]
+        for name, idx, t in zip(fieldnames,idxs,types):
+            columns[name] = columnArray([ a[idx] for a in attrs ],t)
+        if geometry == GEOM_WKB:
+            wkbs = np.empty(len(chunk),dtype=object)
+            wkbs[:] = [ bytes(f.geometry().asWkb()) if f.hasGeometry() else None
+                for f in chunk ]
+            columns[GEOM_WKB] = wkbs
+        elif geometry == GEOM_CENTROID:
+            pts = [ f.geometry().centroid().asPoint() if f.hasGeometry() else None
+                for f in chunk ]
+            columns["x"] = np.array([ p.x() if p else np.nan for p in pts ],dtype=np.float64)
+            columns["y"] = np.array([ p.y() if p else np.nan for p in pts ],dtype=np.float64)
+        return columns
+    chunk = []
+    for f in layer.getFeatures(request):
+        chunk.append(f)
+        if len(chunk) >= chunk_size:
+            yield mkColumns(chunk)
+            chunk = []
+    if chunk:
+        yield mkColumns(chunk)
+
+# Returns all columns of layer (see iterLayerColumns) as one dictionary
+# { column : NumPy array }
+def getLayerColumns(layer,fieldnames=None,geometry=None,request=None):
+    if fieldnames is None:
+        fieldnames = layer.fields().names()
+    chunks = list(iterLayerColumns(layer,fieldnames,geometry=geometry,request=request))
+    if not chunks:
+        names = [FID_COLUMN] + list(fieldnames)
+        if geometry == GEOM_WKB:
+            names.append(GEOM_WKB)
+        elif geometry == GEOM_CENTROID:
+            names += ["x", "y"]
+        return { name : np.array([]) for name in names }
+    return { name : np.concatenate([ c[name] for c in chunks ]) for name in chunks[0] }
+
+# Returns QVariant type of field storing values of NumPy array
+def arrayFieldType(array):
+    if array.dtype.kind in 'biu':
+        return QVariant.LongLong
+    elif array.dtype.kind == 'f':
+        return QVariant.Double
+    else:
+        return QVariant.String
+
+# Writes columns { column : NumPy array } (all of same length) to vector file
+# 'outfname' and returns its path. Geometries are read from GEOM_WKB column
+# if any, FID_COLUMN is ignored and other columns are written as fields whose
+# type is inferred from array type (see arrayFieldType).
+# Features are written by batches of 'batch_size' (see addFeaturesByBatch).
+def writeLayerFromColumns(columns,outfname,crs,wkb_type=QgsWkbTypes.NoGeometry,
+        batch_size=FEATURES_BATCH_SIZE):
+    names = [ n for n in columns if n not in [FID_COLUMN, GEOM_WKB] ]
+    fields = QgsFields()
+    for name in names:
+        fields.append(QgsField(name,arrayFieldType(columns[name])))
+    wkbs = columns.get(GEOM_WKB,None)
+    if wkbs is not None and wkb_type == QgsWkbTypes.NoGeometry:
+        utils.internal_error("No geometry type given to write geometries to " + str(outfname))
+    nb_feats = len(columns[names[0]]) if names else (len(wkbs) if wkbs is not None else 0)
+    writer = createVectorWriter(outfname,fields,wkb_type,crs)
+    def feats():
+        for i in range(nb_feats):
+            f = QgsFeature(fields)
+            if wkbs is not None and wkbs[i] is not None:
+                geom = QgsGeometry()
+                geom.fromWkb(wkbs[i])
+                f.setGeometry(geom)
+            f.setAttributes([ attributeValue(columns[name][i]) for name in names ])
+            yield f
+    addFeaturesByBatch(writer,feats(),batch_size)
+    del writer
+    return outfname
+
+# Returns { fieldname : NumPy array of values } for given fields of layer
+# (see columnArray for NULL values handling)
+def getLayerFieldsArrays(layer,fieldnames):
+    columns = getLayerColumns(layer,fieldnames)
+    return { name : columns[name] for name in fieldnames }
+
 def getLayerFieldUniqueValues(layer,fieldname):
-    path = pathOfLayer(layer)
-    fieldnames = layer.fields().names()
-    if fieldname not in fieldnames:
-        utils.internal_error("No field named '" + fieldname + "' in layer " + path)
+    checkLayerFields(layer,[fieldname])
     field_values = set()
-    for f in layer.getFeatures():
+    for f in layer.getFeatures(attributesRequest(layer,[fieldname])):
         field_values.add(f[fieldname])
     return field_values
 
 def getLayerAssocs(layer,key_field,val_field):
     assoc = {}
-    path = pathOfLayer(layer)
-    fieldnames = layer.fields().names()
-    if key_field not in fieldnames:
-        utils.internal_error("No field named '" + key_field + "' in layer " + path)
-    if val_field not in fieldnames:
-        utils.internal_error("No field named '" + val_field + "' in layer " + path)
-    for f in layer.getFeatures():
+    checkLayerFields(layer,[key_field,val_field])
+    for f in layer.getFeatures(attributesRequest(layer,[key_field,val_field])):
         k = f[key_field]
         v = f[val_field]
         if k in assoc:
@@ -546,6 +1187,7 @@ def exportRaster(array,rasterSource,path,
         utils.internal_error("Could not apply GDAL creation options : " + str(copt))
 
     driver = gdal.GetDriverByName('GTiff')
+    utils.releaseFile(path)
     # Create File based in path
     try:
         outDs = driver.Create(path, cols, rows, 1, out_type, copt)
@@ -570,21 +1212,364 @@ def exportRaster(array,rasterSource,path,
 
     band = outDs = None # Close writing
 
-def getRasterValsFromPath(path):
+# Approximate number of pixels read at once when a raster is processed by blocks
+DEFAULT_TILE_NB_PIXELS = 4194304
+
+# Returns (x_size,y_size) of blocks to read from GDAL band.
+# If tile_size is given, blocks are tile_size x tile_size squares.
+# Otherwise GDAL natural block size is used, strips being grouped
+# so that a block contains about DEFAULT_TILE_NB_PIXELS pixels.
+def getRasterBlockSize(band,tile_size=None):
+    if tile_size:
+        return (int(tile_size),int(tile_size))
+    block_x, block_y = band.GetBlockSize()
+    cols, rows = band.XSize, band.YSize
+    if block_x >= cols:
+        nb_strips = max(1,DEFAULT_TILE_NB_PIXELS // (cols * block_y))
+        return (cols,min(rows,block_y * nb_strips))
+    return (block_x,block_y)
+
+# Yields windows (x_offset,y_offset,x_size,y_size) covering whole band
+def iterRasterWindows(band,tile_size=None):
+    block_x, block_y = getRasterBlockSize(band,tile_size=tile_size)
+    cols, rows = band.XSize, band.YSize
+    for y_off in range(0,rows,block_y):
+        y_size = min(block_y,rows - y_off)
+        for x_off in range(0,cols,block_x):
+            x_size = min(block_x,cols - x_off)
+            yield (x_off,y_off,x_size,y_size)
+
+# Yields (x_offset,y_offset,array) for each block of band
+def iterRasterBlocks(band,tile_size=None):
+    for x_off, y_off, x_size, y_size in iterRasterWindows(band,tile_size=tile_size):
+        yield (x_off,y_off,band.ReadAsArray(x_off,y_off,x_size,y_size))
+
+# Lazy array on a single raster band, pixels are only read when accessed.
+# Indexing (proxy[rows,cols]) reads the matching window, iterBlocks walks
+# raster block by block and np.asarray(proxy) loads the whole band.
+class RasterArrayProxy:
+
+    ndim = 2
+
+    def __init__(self,path,band_idx=1,tile_size=None):
+        self.path = str(path)
+        self.band_idx = band_idx
+        self.tile_size = tile_size
+        self.raster = gdal.Open(self.path)
+        if not self.raster:
+            utils.user_error("Could not open raster path '" + self.path + "'")
+        band = self.getBand()
+        self.shape = (band.YSize,band.XSize)
+        self.size = band.YSize * band.XSize
+        self.nodata = band.GetNoDataValue()
+        self.dtype = band.ReadAsArray(0,0,1,1).dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "RasterArrayProxy(" + self.path + ", shape=" + str(self.shape) + ")"
+
+    def getBand(self):
+        return self.raster.GetRasterBand(self.band_idx)
+
+    # Returns (offset,size,indexes) to read along axis of length n
+    @staticmethod
+    def windowOfKey(key,n):
+        if isinstance(key,slice):
+            idx = np.arange(*key.indices(n))
+        else:
+            key = int(key)
+            if key < 0:
+                key += n
+            if key < 0 or key >= n:
+                raise IndexError("Index " + str(key) + " out of bounds for size " + str(n))
+            idx = key
+        if np.size(idx) == 0:
+            return (0,0,idx)
+        offset = int(np.min(idx))
+        size = int(np.max(idx)) - offset + 1
+        return (offset,size,idx - offset)
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key = (key,slice(None))
+        if len(key) != 2:
+            raise IndexError("RasterArrayProxy expects 2 indexes, got " + str(len(key)))
+        y_off, y_size, y_idx = self.windowOfKey(key[0],self.shape[0])
+        x_off, x_size, x_idx = self.windowOfKey(key[1],self.shape[1])
+        if y_size == 0 or x_size == 0:
+            window = np.empty((y_size,x_size),dtype=self.dtype)
+        else:
+            window = self.getBand().ReadAsArray(x_off,y_off,x_size,y_size)
+        return window[y_idx][...,x_idx]
+
+    def __array__(self,dtype=None,copy=None):
+        array = self.getBand().ReadAsArray()
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    # Yields (x_offset,y_offset,array) for each block of raster
+    def iterBlocks(self):
+        return iterRasterBlocks(self.getBand(),tile_size=self.tile_size)
+
+# Creates single band GeoTIFF 'path' with same dimensions and georeferencing as
+# GDAL dataset 'ref_raster'
+def createRasterLike(ref_raster,path,out_type,nodata=None,copt=GTIFF_COPT):
+    if copt is None:
+        copt = []
+    driver = gdal.GetDriverByName('GTiff')
+    utils.releaseFile(str(path))
+    try:
+        out_ds = driver.Create(str(path),ref_raster.RasterXSize,ref_raster.RasterYSize,
+            1,out_type,copt)
+    except RuntimeError:
+        utils.internal_error("Could not overwrite file " + str(path) + ". Check permissions!")
+    if out_ds is None:
+        utils.internal_error("Could not create output file " + str(path) + ". Check permissions!")
+    out_ds.SetGeoTransform(ref_raster.GetGeoTransform())
+    out_ds.SetProjection(ref_raster.GetProjection())
+    if nodata is not None:
+        out_ds.GetRasterBand(1).SetNoDataValue(float(nodata))
+    return out_ds
+
+# Namespace to evaluate gdal_calc formulas (less, logical_and, where, ...)
+NUMPY_CALC_NAMESPACE = { k : getattr(np,k) for k in dir(np) if not k.startswith('_') }
+
+# Returns boolean mask of NoData pixels
+def noDataMask(array,nodata):
+    if np.isnan(nodata):
+        return np.isnan(array)
+    return array == nodata
+
+# Opens calculator inputs { 'A' : path, ... } and checks they share the same dimensions.
+# Returns sorted input names, reference raster and input bands.
+def openCalcInputs(inputs,bands=None):
+    names = sorted(inputs.keys())
+    if not names:
+        utils.internal_error("No input for raster calculator")
+    bands = bands if bands else {}
+    rasters = {}
+    for name in names:
+        raster = gdal.Open(str(inputs[name]))
+        if not raster:
+            utils.user_error("Could not open raster path '" + str(inputs[name]) + "'")
+        rasters[name] = raster
+    ref_name = names[0]
+    ref_raster = rasters[ref_name]
+    for name in names:
+        if (rasters[name].RasterXSize != ref_raster.RasterXSize
+                or rasters[name].RasterYSize != ref_raster.RasterYSize):
+            utils.user_error("Raster '" + str(inputs[name]) + "' dimensions do not match '"
+                + str(inputs[ref_name]) + "' dimensions")
+    in_bands = { name : rasters[name].GetRasterBand(bands.get(name,1)) for name in names }
+    return names, ref_raster, in_bands
+
+# Evaluates compiled formula on namespace arrays and returns a block of given shape
+def evalCalcBlock(code,arrays,shape):
+    namespace = dict(NUMPY_CALC_NAMESPACE)
+    namespace.update(arrays)
+    with np.errstate(all='ignore'):
+        res = eval(code,{ "__builtins__" : {} },namespace) # nosec B307
+    res = np.broadcast_to(np.ma.getdata(res),shape)
+    if res.dtype == np.bool_:
+        res = res.astype(np.uint8)
+    return res
+
+# Evaluates formula 'expr' (gdal_calc syntax, e.g. 'A*less(A,B)') block by block.
+# Inputs are given as a dictionary { 'A' : path, 'B' : path, ... } and must share
+# the same dimensions, 'bands' optionally gives band number of each input.
+# As in gdal_calc, output pixels are set to 'nodata' where any input is NoData.
+# Each input is read once and output GeoTIFF 'out_path' is written once.
+def applyNumpyCalc(inputs,out_path,expr,nodata=None,out_type=gdal.GDT_Float32,
+        bands=None,copt=GTIFF_COPT,tile_size=None,feedback=None):
+    names, ref_raster, in_bands = openCalcInputs(inputs,bands=bands)
+    nodata = None if nodata is None else float(nodata)
+    in_nodata = { name : in_bands[name].GetNoDataValue() for name in names }
+    code = compile(expr,'<raster calc>','eval')
+    out_ds = createRasterLike(ref_raster,out_path,out_type,nodata=nodata,copt=copt)
+    out_band = out_ds.GetRasterBand(1)
+    windows = list(iterRasterWindows(in_bands[names[0]],tile_size=tile_size))
+    for cpt, (x_off, y_off, x_size, y_size) in enumerate(windows):
+        if feedback and feedback.isCanceled():
+            break
+        arrays = {}
+        nodata_mask = None
+        for name in names:
+            array = in_bands[name].ReadAsArray(x_off,y_off,x_size,y_size)
+            arrays[name] = array
+            if in_nodata[name] is not None:
+                mask = noDataMask(array,in_nodata[name])
+                nodata_mask = mask if nodata_mask is None else (nodata_mask | mask)
+        res = evalCalcBlock(code,arrays,(y_size,x_size))
+        if nodata is not None and nodata_mask is not None:
+            res = np.where(nodata_mask,nodata,res)
+        out_band.WriteArray(res,x_off,y_off)
+        if feedback:
+            feedback.setProgress(100 * (cpt + 1) / len(windows))
+    out_band.FlushCache()
+    out_band = out_ds = None # Close writing
+    return out_path
+
+# Evaluates binary formula 'expr' on rasters 'path_a' and 'path_b' block by block
+# with NoData merging : output is 'expr' where both A and B are defined, A (resp. B)
+# where only A (resp. B) is defined, and 'nodata' where both are NoData.
+# A and B are read once as masked arrays and output is written once, which
+# replaces the r.null / raster calculator / reset pipeline.
+def applyNumpyCalcABNull(path_a,path_b,out_path,expr,nodata,out_type=gdal.GDT_Float32,
+        copt=GTIFF_COPT,tile_size=None,feedback=None):
+    names, ref_raster, in_bands = openCalcInputs({ 'A' : path_a, 'B' : path_b })
+    nodata = float(nodata)
+    in_nodata = { name : in_bands[name].GetNoDataValue() for name in names }
+    code = compile(expr,'<raster calc>','eval')
+    out_ds = createRasterLike(ref_raster,out_path,out_type,nodata=nodata,copt=copt)
+    out_band = out_ds.GetRasterBand(1)
+    windows = list(iterRasterWindows(in_bands['A'],tile_size=tile_size))
+    for cpt, (x_off, y_off, x_size, y_size) in enumerate(windows):
+        if feedback and feedback.isCanceled():
+            break
+        arrays = {}
+        for name in names:
+            array = in_bands[name].ReadAsArray(x_off,y_off,x_size,y_size)
+            mask = False if in_nodata[name] is None else noDataMask(array,in_nodata[name])
+            arrays[name] = np.ma.masked_array(array,mask=mask)
+        a, b = arrays['A'], arrays['B']
+        a_nd, b_nd = np.ma.getmaskarray(a), np.ma.getmaskarray(b)
+        res = evalCalcBlock(code,arrays,(y_size,x_size))
+        res = np.where(a_nd,b.data,np.where(b_nd,a.data,res))
+        res = np.where(a_nd & b_nd,nodata,res)
+        out_band.WriteArray(res,x_off,y_off)
+        if feedback:
+            feedback.setProgress(100 * (cpt + 1) / len(windows))
+    out_band.FlushCache()
+    out_band = out_ds = None # Close writing
+    return out_path
+
+# Casts array to dtype as GDAL does when writing a band (integer
+# values are rounded and clamped to dtype range)
+def castLikeGdal(array,dtype):
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype,np.integer) and not np.issubdtype(array.dtype,np.integer):
+        info = np.iinfo(dtype)
+        array = np.clip(np.rint(np.nan_to_num(array)),info.min,info.max)
+    return array.astype(dtype)
+
+# Reclassifies array as native:reclassifybytable does. 'table' is a flat list
+# [min1, max1, val1, min2, ...] where empty or None bounds are unbounded.
+# Boundaries mode : 0 = min < v <= max, 1 = min <= v < max,
+# 2 = min <= v <= max, 3 = min < v < max. First matching range applies.
+# Returns reclassified values and mask of values matching no range.
+def reclassifyArray(array,table,boundaries_mode=1):
+    if len(table) % 3 != 0:
+        utils.user_error("Reclassification table length must be a multiple of 3")
+    res = array.astype(np.float64)
+    missing = np.ones(array.shape,dtype=bool)
+    for i in range(0,len(table),3):
+        min_val, max_val, new_val = table[i:i+3]
+        in_range = missing.copy()
+        if min_val not in [None,'']:
+            min_val = float(min_val)
+            in_range &= (array > min_val) if boundaries_mode in [0,3] else (array >= min_val)
+        if max_val not in [None,'']:
+            max_val = float(max_val)
+            in_range &= (array <= max_val) if boundaries_mode in [0,2] else (array < max_val)
+        res[in_range] = float(new_val)
+        missing &= ~in_range
+    return res, missing
+
+# Maximal range of integer values counted with np.bincount in a single block
+BINCOUNT_MAX_RANGE = 65536
+
+# Returns values of array that are not NoData, as a flat array
+def maskNoData(array,nodata):
+    vals = array.ravel()
+    if nodata is None:
+        return vals
+    if np.isnan(nodata):
+        return vals[~np.isnan(vals)]
+    return vals[vals != nodata]
+
+# Merges two (values,counts) pairs of sorted arrays
+def mergeValsCounts(vals1,counts1,vals2,counts2):
+    if vals1 is None:
+        return vals2, counts2
+    vals, inverse = np.unique(np.concatenate((vals1,vals2)),return_inverse=True)
+    counts = np.zeros(vals.size,dtype=np.int64)
+    np.add.at(counts,inverse.ravel(),np.concatenate((counts1,counts2)))
+    return vals, counts
+
+# Counts values of integer array with np.bincount if values range is small enough
+def bincountVals(vals):
+    vmin, vmax = int(vals.min()), int(vals.max())
+    if vmax - vmin >= BINCOUNT_MAX_RANGE:
+        return np.unique(vals,return_counts=True)
+    hist = np.bincount((vals - vmin).astype(np.intp))
+    nz = np.flatnonzero(hist)
+    return nz + vmin, hist[nz]
+
+# Returns (values,counts) sorted arrays of band values, read block by block.
+# NoData pixels (band NoData value if nodata is None) are masked before counting.
+# Byte/Int16/UInt16 values are accumulated in a single histogram, other integer
+# types are counted with np.bincount on each block when its values range is
+# small and np.unique otherwise (sparse large ranges, floats).
+def getBandValsCounts(band,nodata=None,tile_size=None):
+    if nodata is None:
+        nodata = band.GetNoDataValue()
+    hist, hist_offset = None, 0
+    vals, counts = None, None
+    for x_off, y_off, block in iterRasterBlocks(band,tile_size=tile_size):
+        block_vals = maskNoData(block,nodata)
+        if block_vals.size == 0:
+            continue
+        if block_vals.dtype.kind in 'iu' and block_vals.dtype.itemsize <= 2:
+            if hist is None:
+                type_info = np.iinfo(block_vals.dtype)
+                hist_offset = int(type_info.min)
+                hist = np.zeros(int(type_info.max) - hist_offset + 1,dtype=np.int64)
+            hist += np.bincount(block_vals.astype(np.intp) - hist_offset,minlength=hist.size)
+        else:
+            if block_vals.dtype.kind in 'iu':
+                block_vals, block_counts = bincountVals(block_vals)
+            else:
+                block_vals, block_counts = np.unique(block_vals,return_counts=True)
+            vals, counts = mergeValsCounts(vals,counts,block_vals,block_counts)
+    if hist is not None:
+        nz = np.flatnonzero(hist)
+        vals, counts = mergeValsCounts(vals,counts,nz + hist_offset,hist[nz])
+    if vals is None:
+        vals, counts = np.array([]), np.array([],dtype=np.int64)
+    return vals, counts
+
+# Returns (values,counts,nodata) of raster first band, NoData excluded.
+# Result is stored in raster statistics cache.
+def getRasterValsCounts(path,tile_size=None):
+    cached = raster_stats_cache.get(path,"vals")
+    if cached is not None:
+        return cached["values"], cached["counts"], cached["nodata"]
     gdal_layer = gdal.Open(path)
     if not gdal_layer:
         utils.user_error("Could not load raster " + str(path))
     band1 = gdal_layer.GetRasterBand(1)
-    data_array = band1.ReadAsArray()
-    unique_vals = set(np.unique(data_array))
-    utils.debug("Unique values init : " + str(unique_vals))
     in_nodata_val = band1.GetNoDataValue()
     utils.debug("in_nodata_val = " + str(in_nodata_val))
-    if in_nodata_val in unique_vals:
-        unique_vals.remove(in_nodata_val)
+    vals, counts = getBandValsCounts(band1,nodata=in_nodata_val,tile_size=tile_size)
+    vals, counts = vals.tolist(), counts.tolist()
+    raster_stats_cache.put(path,"vals",
+        { "values" : vals, "counts" : counts, "nodata" : in_nodata_val })
+    return vals, counts, in_nodata_val
+
+def getRasterValsFromPath(path,tile_size=None):
+    vals, counts, nodata = getRasterValsCounts(path,tile_size=tile_size)
+    unique_vals = set(vals)
     utils.debug("Unique values : " + str(unique_vals))
     return unique_vals
 
+# Returns histogram {value : nb_pixels} of raster first band, NoData excluded
+def getRasterHistogram(path,tile_size=None):
+    vals, counts, nodata = getRasterValsCounts(path,tile_size=tile_size)
+    return dict(zip(vals,counts))
+
 # IMPORT GDAL OR NOT ?
 def getRasterValsOld(layer):
     path = pathOfLayer(layer)
@@ -599,6 +1584,30 @@ def getRasterValsOld(layer):
     utils.debug("Unique values : " + str(unique_vals))
     return unique_vals
 
+# NumPy types matching QGIS raster data types
+QGIS_NUMPY_TYPES = {
+    Qgis.DataType.Byte : np.uint8,
+    Qgis.DataType.UInt16 : np.uint16,
+    Qgis.DataType.Int16 : np.int16,
+    Qgis.DataType.UInt32 : np.uint32,
+    Qgis.DataType.Int32 : np.int32,
+    Qgis.DataType.Float32 : np.float32,
+    Qgis.DataType.Float64 : np.float64 }
+
+# Returns (rows,cols) NumPy array viewing QgsRasterBlock data (no copy when
+# QByteArray exposes buffer protocol, read-only in any case)
+def rasterBlockAsArray(bl):
+    data_type = bl.dataType()
+    if data_type not in QGIS_NUMPY_TYPES:
+        utils.internal_error("Unsupported raster block type " + str(data_type))
+    dtype = QGIS_NUMPY_TYPES[data_type]
+    data = bl.data()
+    try:
+        array = np.frombuffer(data,dtype=dtype)
+    except TypeError:
+        array = np.frombuffer(bytes(data),dtype=dtype)
+    return array.reshape((bl.height(),bl.width()))
+
 def getRasterValsBis(layer):
     if layer is None:
         return []
@@ -606,12 +1615,25 @@ def getRasterValsBis(layer):
     cols = layer.width()
     dpr = layer.dataProvider()
     bl = dpr.block(1, dpr.extent(), cols, rows) # 1: band no
-    nodata_val = dpr.sourceNoDataValue(1)
-    unique_values = set([bl.value(r, c) for r in range(rows) for c in range(cols)])
-    unique_values.remove(nodata_val)
-    return list(unique_values)
-
-def getRasterValsAndArray(path,nodata=None):
+    nodata_val = dpr.sourceNoDataValue(1) if dpr.sourceHasNoDataValue(1) else None
+    array = rasterBlockAsArray(bl)
+    unique_values = np.unique(maskNoData(array,nodata_val))
+    return unique_values.tolist()
+
+# Returns sorted values of band (NoData excluded), read block by block
+def getBandUniqueVals(band,nodata=None,tile_size=None):
+    vals, counts = getBandValsCounts(band,nodata=nodata,tile_size=tile_size)
+    return vals
+
+# Returns sorted classes of raster and its band array.
+# If tiled is True, raster is read block by block (GDAL natural block size
+# or tile_size x tile_size blocks) and a RasterArrayProxy is returned instead
+# of the full array, so that memory usage is bounded by one block.
+def getRasterValsAndArray(path,nodata=None,tiled=False,tile_size=None):
+    classes, array, nodata = getRasterValsArrayND(path,nodata=nodata,
+        tiled=tiled,tile_size=tile_size)
+    return classes, array
+def getRasterValsArrayND(path,nodata=None,tiled=False,tile_size=None):
     raster = gdal.Open(str(path))
     if not raster:
         utils.user_error("Could not open raster path '" + str(path) + "'")
@@ -619,33 +1641,17 @@ def getRasterValsAndArray(path,nodata=None):
         band = raster.GetRasterBand(1)
         if nodata == None:
             nodata = band.GetNoDataValue()
-        try:
-            array =  band.ReadAsArray()
-        except ValueError:
-            utils.internal_error("Raster file is too big for processing. Please crop the file and try again.")
-            return
-        classes = sorted(np.unique(array)) # get classes
-        try:
-            classes.remove(nodata)
-        except ValueError:
-            pass
-        return classes, array
-    else:
-        utils.user_error("Multiband Rasters not implemented yet")
-def getRasterValsArrayND(path,nodata=None):
-    raster = gdal.Open(str(path))
-    if not raster:
-        utils.user_error("Could not open raster path '" + str(path) + "'")
-    if(raster.RasterCount==1):
-        band = raster.GetRasterBand(1)
-        if nodata == None:
-            nodata = band.GetNoDataValue()
-        try:
-            array =  band.ReadAsArray()
-        except ValueError:
-            utils.internal_error("Raster file is too big for processing. Please crop the file and try again.")
-            return
-        classes = sorted(np.unique(array)) # get classes
+        if tiled:
+            classes = getBandUniqueVals(band,nodata=nodata,tile_size=tile_size)
+            array = RasterArrayProxy(path,tile_size=tile_size)
+        else:
+            try:
+                array =  band.ReadAsArray()
+            except ValueError:
+                utils.internal_error("Raster file is too big for processing. Please crop the file or use tiled mode and try again.")
+                return
+            classes = np.unique(array)
+        classes = sorted(classes) # get classes
         try:
             classes.remove(nodata)
         except ValueError:
@@ -662,9 +1668,43 @@ def getRasterValsArrayND(path,nodata=None):
     # utils.debug("hist = " + str(hist))
     # return hist
 
+# Cache of raster statistics (min/max, unique values, histogram, NoData),
+# invalidated when raster file is modified. Set 'RASTER_STATS_CACHE'
+# environment variable to persist it in a SQLite file.
+raster_stats_cache = utils.FileStatsCache(db_path=os.environ.get("RASTER_STATS_CACHE"))
+
+RASTER_STATS_FIELDS = ['minimumValue', 'maximumValue', 'mean', 'stdDev',
+    'range', 'sum', 'elementCount']
+
+# Replaces raster statistics cache, persisted in 'db_path' if given
+def initRasterStatsCache(db_path=None,max_entries=256):
+    global raster_stats_cache
+    raster_stats_cache = utils.FileStatsCache(db_path=db_path,max_entries=max_entries)
+    return raster_stats_cache
+
+# Returns hits/misses/invalidations/evictions counters of raster statistics cache
+def getRasterStatsCacheCounters():
+    return raster_stats_cache.getCounters()
+
+# Returns statistics of raster first band, layer can be given as a path
 def getRasterStats(layer):
+    if isinstance(layer,str):
+        path, layer = layer, None
+    else:
+        path = pathOfLayer(layer)
+    cached = raster_stats_cache.get(path,"stats")
+    if cached is not None:
+        stats = QgsRasterBandStats()
+        stats.bandNumber = 1
+        for k, v in cached.items():
+            setattr(stats,k,v)
+        return stats
+    if layer is None:
+        layer = loadRasterLayer(path)
     pr = layer.dataProvider()
     stats = pr.bandStatistics(1,stats=QgsRasterBandStats.All)
+    raster_stats_cache.put(path,"stats",
+        { f : getattr(stats,f) for f in RASTER_STATS_FIELDS })
     return stats
 
 def getRasterMinMax(layer):
@@ -676,7 +1716,7 @@ def getRastersMinMax(layers):
     if not layers:
         utils.internal_error("No layers selected")
     min, max = getRasterMinMax(layers[0])
-    for l in layers:
+    for l in layers[1:]:
         curr_min, curr_max = getRasterMinMax(l)
         if curr_min < min:
             min = curr_min
@@ -702,10 +1742,8 @@ def getRasterMinMedMax(layer):
     # pass
 
 def getVectorValsOld(layer,field_name):
-    field_values = set()
-    for f in layer.getFeatures():
-        field_values.add(f[field_name])
-    return sorted(field_values)
+    values = getLayerColumns(layer,[field_name])[field_name]
+    return sorted(set(values.tolist()))
 
 def getVectorVals(layer,field_name):
     idx = layer.dataProvider().fieldNameIndex(field_name)
@@ -720,19 +1758,81 @@ def checkProjectionUnit(layer):
 
 """ GPKG """
 
+# Returns (path, table, fid column) of GPKG layer if its features can be
+# accessed directly through OGR SQL (no pending edits nor subset string,
+# all table rows being layer features), None otherwise
+def gpkgLayerTable(layer):
+    if layer.providerType() != 'ogr' or layer.isEditable() or layer.subsetString():
+        return None
+    pr = layer.dataProvider()
+    if pr.storageType() != 'GPKG':
+        return None
+    parts = QgsProviderRegistry.instance().decodeUri('ogr',pr.dataSourceUri())
+    if parts.get('subset',None):
+        return None
+    path = parts.get('path',None)
+    if not path or not os.path.isfile(path):
+        return None
+    ds = ogr.Open(path)
+    if ds is None:
+        return None
+    table = parts.get('layerName',None)
+    ogr_layer = ds.GetLayerByName(table) if table else ds.GetLayer(0)
+    if ogr_layer is None:
+        return None
+    return (path, ogr_layer.GetName(), ogr_layer.GetFIDColumn() or 'fid')
+
 # Geopackages 'fid'
 def getMaxFid(layer):
-    max = 1
-    for f in layer.getFeatures():
-        id = f["fid"]
-        id = f.id()
-        if id > max:
-            max = id
-    return max
-
+    gpkg_table = gpkgLayerTable(layer)
+    if gpkg_table:
+        path, table, fid_col = gpkg_table
+        ds = ogr.Open(path)
+        res = ds.ExecuteSQL('SELECT MAX("' + fid_col + '") FROM "' + table + '"')
+        f = res.GetNextFeature() if res is not None else None
+        max_fid = f.GetField(0) if f is not None else None
+        if res is not None:
+            ds.ReleaseResultSet(res)
+        if max_fid is not None:
+            return max(1,int(max_fid))
+    fids = getLayerColumns(layer,[])[FID_COLUMN]
+    return max(1,int(fids.max())) if fids.size else 1
+
+# Renumbers features ids from 1 (in ascending ids order).
+# GPKG layers are updated with two bulk UPDATE statements in one transaction,
+# other layers feature by feature in an edit session.
 def normFids(layer):
+    gpkg_table = gpkgLayerTable(layer)
+    if gpkg_table:
+        path, table, fid_col = gpkg_table
+        ds = ogr.Open(path,1)
+        # Temporary table rowid gives new fid, ids are first negated
+        # to avoid primary key collisions during renumbering
+        stmts = ['CREATE TEMP TABLE norm_fids AS SELECT "' + fid_col
+                    + '" AS old_fid FROM "' + table + '" ORDER BY "' + fid_col + '"',
+                 'CREATE INDEX temp.norm_fids_idx ON norm_fids (old_fid)',
+                 'UPDATE "' + table + '" SET "' + fid_col + '" = -"' + fid_col + '"',
+                 'UPDATE "' + table + '" SET "' + fid_col + '" = (SELECT rowid FROM '
+                    + 'norm_fids WHERE old_fid = -"' + table + '"."' + fid_col + '")']
+        ds.StartTransaction()
+        try:
+            for stmt in stmts:
+                gdal.ErrorReset()
+                ds.ExecuteSQL(stmt)
+                if gdal.GetLastErrorType() >= gdal.CE_Failure:
+                    utils.internal_error("GPKG SQL failed : " + gdal.GetLastErrorMsg())
+            ds.CommitTransaction()
+        except:
+            ds.RollbackTransaction()
+            raise
+        finally:
+            ds.ExecuteSQL('DROP TABLE IF EXISTS temp.norm_fids')
+            ds = None
+        layer.dataProvider().reloadData()
+        layer.triggerRepaint()
+        return
     max_fid = 1
-    feats = layer.getFeatures()
+    feats = layer.getFeatures(attributesRequest(layer,[]))
     layer.startEditing()
     for f in feats:
         layer.changeAttributeValue(f.id(),0,max_fid)
@@ -26,16 +26,24 @@
     Utility functions independent from QGIS API.
 """
 import ast
+import collections
+import concurrent.futures
 import datetime
+import json
 import os.path
 import pathlib
 import sys
+import sqlite3
 import subprocess
+import tempfile
+import threading
 import time
 import platform
 import glob
+import hashlib
 import csv
 import re
+import shutil
 
 file_dir = os.path.dirname(__file__)
 if file_dir not in sys.path:
@@ -182,7 +190,17 @@ def checkFileExists(fname,prefix=""):
     if not (os.path.isfile(fname)):
         user_error(prefix + "File '" + fname + "' does not exist")
 
+# Functions called with path of a file (or folder) about to be written or
+# deleted, e.g. to release layers keeping it open (see releaseFile)
+file_release_hooks = []
+
+# Notifies that file (or folder) 'path' is about to be written or deleted
+def releaseFile(path):
+    for hook in file_release_hooks:
+        hook(path)
+
 def removeFile(path):
+    releaseFile(path)
     if os.path.isfile(path):
         debug("Deleting existing file '" + path + "'")
         os.remove(path)
@@ -209,6 +227,528 @@ def parseAssocFileCSV(fname,fieldnames):
         raise Exception("File " + str(fname) + " does not exist")
     return res
 
+# CACHE UTILITIES
+
+# Returns (normalized absolute path, modification time, size) of file
+def fileFingerprint(fname):
+    st = os.stat(fname)
+    return (normPath(os.path.abspath(fname)), st.st_mtime_ns, st.st_size)
+
+# Cache of values computed from files (e.g. raster statistics).
+# Entries are keyed by normalized path and invalidated when file modification
+# time or size changes. Each entry stores a dictionary {name : value} of
+# JSON-serializable values. Least recently used entries are evicted beyond
+# 'max_entries'. If 'db_path' is given, entries are persisted in a SQLite
+# database so that they survive between plugin runs.
+class FileStatsCache:
+
+    def __init__(self,db_path=None,max_entries=256):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.db = None
+        self.resetCounters()
+        if db_path:
+            self.db = sqlite3.connect(db_path,check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY,"
+                + " mtime INTEGER, size INTEGER, stats TEXT, last_access REAL)")
+            self.db.commit()
+
+    def resetCounters(self):
+        self.counters = { "hits" : 0, "misses" : 0,
+            "invalidations" : 0, "evictions" : 0 }
+
+    def getCounters(self):
+        with self.lock:
+            res = dict(self.counters)
+            res["entries"] = len(self.entries)
+            return res
+
+    def loadEntry(self,path):
+        if path in self.entries:
+            return self.entries[path]
+        if self.db is None:
+            return None
+        row = self.db.execute("SELECT mtime, size, stats FROM entries WHERE path = ?",
+            (path,)).fetchone()
+        if row is None:
+            return None
+        entry = (row[0], row[1], json.loads(row[2]))
+        self.entries[path] = entry
+        self.trimEntries()
+        return entry
+
+    # Evicts least recently used entries beyond 'max_entries'
+    def trimEntries(self):
+        while len(self.entries) > self.max_entries:
+            old_path, old_entry = self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+            if self.db is not None:
+                self.db.execute("DELETE FROM entries WHERE path = ?",(old_path,))
+        if self.db is not None:
+            self.db.execute("DELETE FROM entries WHERE path NOT IN"
+                + " (SELECT path FROM entries ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,))
+            self.db.commit()
+
+    def storeEntry(self,path,entry):
+        self.entries[path] = entry
+        self.entries.move_to_end(path)
+        if self.db is not None:
+            mtime, size, stats = entry
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)",
+                (path,mtime,size,json.dumps(stats),time.time()))
+        self.trimEntries()
+
+    def removeEntry(self,path):
+        self.entries.pop(path,None)
+        if self.db is not None:
+            self.db.execute("DELETE FROM entries WHERE path = ?",(path,))
+            self.db.commit()
+
+    # Rolls back pending database changes after a database error
+    # (e.g. database locked by another session), cache then acting as a miss
+    def dbError(self,e):
+        debug("Statistics cache database error : " + str(e))
+        try:
+            self.db.rollback()
+        except sqlite3.Error:
+            pass
+
+    # Returns value 'name' cached for file 'fname', None if not found or outdated
+    def get(self,fname,name):
+        try:
+            path, mtime, size = fileFingerprint(fname)
+        except OSError:
+            return None
+        with self.lock:
+            try:
+                entry = self.loadEntry(path)
+                if entry is not None and (entry[0] != mtime or entry[1] != size):
+                    self.counters["invalidations"] += 1
+                    self.removeEntry(path)
+                    entry = None
+                if entry is None or name not in entry[2]:
+                    self.counters["misses"] += 1
+                    return None
+                self.counters["hits"] += 1
+                self.entries.move_to_end(path)
+                if self.db is not None:
+                    try:
+                        self.db.execute("UPDATE entries SET last_access = ? WHERE path = ?",
+                            (time.time(),path))
+                        self.db.commit()
+                    except sqlite3.Error as e:
+                        self.dbError(e)
+                return entry[2][name]
+            except sqlite3.Error as e:
+                self.dbError(e)
+                self.counters["misses"] += 1
+                return None
+
+    # Stores value 'name' computed from file 'fname'
+    def put(self,fname,name,value):
+        try:
+            path, mtime, size = fileFingerprint(fname)
+        except OSError:
+            return
+        with self.lock:
+            try:
+                entry = self.loadEntry(path)
+            except sqlite3.Error as e:
+                self.dbError(e)
+                entry = self.entries.get(path,None)
+            if entry is None or entry[0] != mtime or entry[1] != size:
+                stats = {}
+            else:
+                stats = entry[2]
+            stats[name] = value
+            try:
+                self.storeEntry(path,(mtime,size,stats))
+            except sqlite3.Error as e:
+                self.dbError(e)
+
+    # Removes entry of file 'fname' if any
+    def invalidate(self,fname):
+        path = normPath(os.path.abspath(fname))
+        with self.lock:
+            try:
+                self.removeEntry(path)
+            except sqlite3.Error as e:
+                self.dbError(e)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM entries")
+                self.db.commit()
+            self.resetCounters()
+
+# Sidecar files extensions (appended to file stem)
+SHAPEFILE_SIDECARS = ['.shx','.dbf','.prj','.cpg','.qix','.sbn','.sbx','.qpj']
+# Sidecar files extensions (appended to full file name)
+RASTER_SIDECARS = ['.aux.xml','.ovr']
+
+# Returns existing files making up dataset 'fname' (main file first)
+def datasetFiles(fname):
+    stem, ext = os.path.splitext(fname)
+    res = [fname]
+    if ext.lower() == '.shp':
+        res += [ stem + e for e in SHAPEFILE_SIDECARS ]
+    res += [ fname + e for e in RASTER_SIDECARS ]
+    return [ f for f in res if os.path.isfile(f) ]
+
+# Returns total size in bytes of files
+def filesSize(fnames):
+    return sum(os.path.getsize(f) for f in fnames if os.path.isfile(f))
+
+# Cache of computation results stored in directory 'cache_dir'.
+# Each entry is identified by a key (e.g. hash of computation inputs) and
+# stores output files (copied to 'cache_dir/<key>/') and JSON-serializable
+# output values, along with the computation time. Index of entries is
+# persisted in 'cache_dir/index.json'. Least recently used entries are
+# evicted when total size of cached files exceeds 'max_size' bytes.
+# Counters of hits, misses and saved seconds are kept for each label
+# (e.g. algorithm name).
+class FileResultCache:
+
+    def __init__(self,cache_dir,max_size=1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.index_path = os.path.join(cache_dir,"index.json")
+        self.entries = {}
+        self.report = {}
+        mkDir(cache_dir)
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                warn("Could not read cache index " + str(self.index_path))
+                self.entries = {}
+
+    def saveIndex(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path,"w") as f:
+            json.dump(self.entries,f)
+        os.replace(tmp_path,self.index_path)
+
+    def entryDir(self,key):
+        return os.path.join(self.cache_dir,key)
+
+    def labelReport(self,label):
+        return self.report.setdefault(label,
+            { "hits" : 0, "misses" : 0, "saved_seconds" : 0.0 })
+
+    def getReport(self):
+        with self.lock:
+            return { k : dict(v) for k, v in self.report.items() }
+
+    def totalSize(self):
+        return sum(e["size"] for e in self.entries.values())
+
+    # Returns entry of 'key', None if not found or if cached files are missing
+    def get(self,key,label=None):
+        with self.lock:
+            entry = self.entries.get(key,None)
+            if entry is not None:
+                for out in entry["outputs"].values():
+                    files = [ os.path.join(self.entryDir(key),f) for f in out.get("files",[]) ]
+                    if not all(os.path.isfile(f) for f in files):
+                        self.remove(key)
+                        entry = None
+                        break
+            report = self.labelReport(label)
+            if entry is None:
+                report["misses"] += 1
+                return None
+            report["hits"] += 1
+            report["saved_seconds"] += entry["seconds"]
+            entry["last_access"] = time.time()
+            self.saveIndex()
+            return entry
+
+    # Stores outputs { name : file path or value } computed in 'seconds'.
+    # Output 'name' is a file if listed in 'file_outputs'.
+    def put(self,key,outputs,file_outputs,seconds,label=None):
+        with self.lock:
+            self.remove(key)
+            entry_dir = self.entryDir(key)
+            mkDir(entry_dir)
+            stored, size = {}, 0
+            for name, value in outputs.items():
+                if name not in file_outputs:
+                    stored[name] = { "value" : value }
+                    continue
+                out_dir = os.path.join(entry_dir,name)
+                mkDir(out_dir)
+                files = []
+                for fname in datasetFiles(value):
+                    shutil.copyfile(fname,os.path.join(out_dir,os.path.basename(fname)))
+                    files.append(os.path.join(name,os.path.basename(fname)))
+                    size += os.path.getsize(fname)
+                stored[name] = { "files" : files }
+            self.entries[key] = { "label" : label, "outputs" : stored,
+                "seconds" : seconds, "size" : size, "last_access" : time.time() }
+            self.trim()
+            self.saveIndex()
+
+    # Copies cached files of output 'name' to 'out_path', returns 'out_path'
+    def restore(self,key,name,out_path):
+        files = self.entries[key]["outputs"][name]["files"]
+        main_stem = os.path.splitext(os.path.basename(files[0]))[0]
+        out_stem = os.path.splitext(out_path)[0]
+        if os.path.dirname(out_path):
+            mkDir(os.path.dirname(out_path))
+        for f in files:
+            suffix = os.path.basename(f)[len(main_stem):]
+            shutil.copyfile(os.path.join(self.entryDir(key),f),out_stem + suffix)
+        return out_path
+
+    # Evicts least recently used entries while total size exceeds 'max_size'
+    def trim(self):
+        while len(self.entries) > 1 and self.totalSize() > self.max_size:
+            key = min(self.entries,key=lambda k : self.entries[k]["last_access"])
+            self.remove(key)
+
+    def remove(self,key):
+        if self.entries.pop(key,None) is not None:
+            shutil.rmtree(self.entryDir(key),ignore_errors=True)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.remove(key)
+            self.saveIndex()
+            self.report = {}
+
+# SCHEDULING UTILITIES
+
+# Task of DAGScheduler : 'func' is called without argument and produces
+# files 'outputs' from files 'inputs'. 'params' (JSON-serializable) are the
+# task parameters, whose hash is recorded in scheduler state when task is run.
+class DAGTask:
+
+    def __init__(self,name,func,inputs=[],outputs=[],params=None):
+        self.name = name
+        self.func = func
+        self.inputs = [ normPath(os.path.abspath(p)) for p in inputs if p ]
+        self.outputs = [ normPath(os.path.abspath(p)) for p in outputs if p ]
+        self.params_hash = None
+        if params is not None:
+            params_str = json.dumps(params,sort_keys=True,default=str)
+            self.params_hash = hashlib.sha256(params_str.encode('utf-8')).hexdigest()
+        self.deps = []
+        # None (not run), 'done', 'skipped', 'failed' or 'canceled'
+        self.status = None
+        self.result = None
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+# Runs tasks in dependency order, task A being a dependency of task B if an
+# output of A is an input of B. Ready tasks are run concurrently with
+# 'nb_workers' threads. As with make, a task is skipped if its outputs exist
+# and are newer than its inputs, if its parameters did not change since
+# its last run and if none of its dependencies has been run (unless 'force'
+# is True). Tasks without declared inputs are always run.
+# Parameters hashes of run tasks outputs are stored in JSON file 'state_path'
+# (default to a file in temporary directory).
+# 'wait_func' is called regularly from calling thread while tasks are running
+# (e.g. to update progress), 'end_func(task)' is called from calling thread
+# when a task ends and 'cancel_func()' returns True if run must be canceled.
+class DAGScheduler:
+
+    def __init__(self,nb_workers=1,force=False,
+            wait_func=None,end_func=None,cancel_func=None,state_path=None):
+        self.nb_workers = nb_workers
+        if state_path is None:
+            state_path = os.path.join(tempfile.gettempdir(),"qgis_lib_mc_dag_state.json")
+        self.state_path = state_path
+        # { output path : parameters hash of last run producing it }
+        self.state = {}
+        self.updated_state = {}
+        self.state_lock = threading.Lock()
+        self.force = force
+        self.wait_func = wait_func
+        self.end_func = end_func
+        self.cancel_func = cancel_func
+        self.tasks = collections.OrderedDict()
+        self.wall_time = 0.0
+
+    def addTask(self,name,func,inputs=[],outputs=[],params=None):
+        if name in self.tasks:
+            internal_error("Task '" + str(name) + "' already exists")
+        task = DAGTask(name,func,inputs=inputs,outputs=outputs,params=params)
+        self.tasks[name] = task
+        return task
+
+    # Computes tasks dependencies and returns tasks in topological order
+    def buildGraph(self):
+        producers = {}
+        for task in self.tasks.values():
+            for out in task.outputs:
+                if out in producers:
+                    user_error("File '" + out + "' is produced by both '"
+                        + producers[out].name + "' and '" + task.name + "'")
+                producers[out] = task
+        for task in self.tasks.values():
+            task.deps = []
+            for input in task.inputs:
+                dep = producers.get(input,None)
+                if dep is not None and dep is not task and dep not in task.deps:
+                    task.deps.append(dep)
+        order, visited, visiting = [], set(), set()
+        def visit(task):
+            if task.name in visited:
+                return
+            if task.name in visiting:
+                user_error("Dependency cycle detected on task '" + task.name + "'")
+            visiting.add(task.name)
+            for dep in task.deps:
+                visit(dep)
+            visiting.discard(task.name)
+            visited.add(task.name)
+            order.append(task)
+        for task in self.tasks.values():
+            visit(task)
+        return order
+
+    # Returns True if task outputs exist and are newer than its inputs
+    # and if task parameters did not change
+    def isUpToDate(self,task):
+        if self.force or not task.inputs or not task.outputs:
+            return False
+        if task.params_hash is not None and any(
+                self.state.get(out,None) != task.params_hash for out in task.outputs):
+            return False
+        if any(dep.status == 'done' for dep in task.deps):
+            return False
+        try:
+            out_time = min(os.path.getmtime(out) for out in task.outputs)
+        except OSError:
+            return False
+        in_times = [ os.path.getmtime(i) for i in task.inputs if os.path.exists(i) ]
+        return len(in_times) == len(task.inputs) and max(in_times) <= out_time
+
+    def runTask(self,task):
+        task.start_time = time.time()
+        try:
+            task.result = task.func()
+            if task.params_hash is not None:
+                with self.state_lock:
+                    for out in task.outputs:
+                        self.state[out] = task.params_hash
+                        self.updated_state[out] = task.params_hash
+        finally:
+            task.end_time = time.time()
+        return task.result
+
+    def readState(self):
+        try:
+            with open(self.state_path,encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def loadState(self):
+        self.state = self.readState()
+        self.updated_state = {}
+
+    # Saves hashes recorded during run, merged with current file content
+    # (state file may be shared by several schedulers)
+    def saveState(self):
+        if not self.updated_state:
+            return
+        state = self.readState()
+        state.update(self.updated_state)
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path,"w",encoding="utf-8") as f:
+                json.dump(state,f)
+            os.replace(tmp_path,self.state_path)
+        except OSError as e:
+            warn("Could not save scheduler state to " + str(self.state_path) + " : " + str(e))
+
+    # Runs tasks, raises first error once running tasks are finished
+    def run(self):
+        order = self.buildGraph()
+        self.loadState()
+        try:
+            return self.runTasks(order)
+        finally:
+            self.saveState()
+
+    def runTasks(self,order):
+        start_time = time.time()
+        pending = list(order)
+        running = {}
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nb_workers) as executor:
+            while pending or running:
+                canceled = error is not None or (self.cancel_func and self.cancel_func())
+                for task in list(pending):
+                    if canceled:
+                        task.status = 'canceled'
+                        pending.remove(task)
+                    elif all(dep.status in ['done','skipped'] for dep in task.deps):
+                        pending.remove(task)
+                        if self.isUpToDate(task):
+                            task.status = 'skipped'
+                            if self.end_func:
+                                self.end_func(task)
+                        else:
+                            running[executor.submit(self.runTask,task)] = task
+                    elif any(dep.status in ['failed','canceled'] for dep in task.deps):
+                        task.status = 'canceled'
+                        pending.remove(task)
+                if not running:
+                    continue
+                done, not_done = concurrent.futures.wait(running,timeout=0.1,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        task.status = 'failed'
+                        error = error or future.exception()
+                    else:
+                        task.status = 'done'
+                    if self.end_func:
+                        self.end_func(task)
+                if self.wait_func:
+                    self.wait_func()
+        self.wall_time = time.time() - start_time
+        if error is not None:
+            raise error
+        return { name : task.status for name, task in self.tasks.items() }
+
+    # Returns (list of tasks, duration) of the longest chain of dependent tasks
+    # by run duration, i.e. the lower bound of wall-clock time whatever
+    # the number of workers
+    def criticalPath(self):
+        best = {}
+        for task in self.buildGraph():
+            prev = max(task.deps,key=lambda d : best[d.name][1],default=None)
+            total = task.duration() + (best[prev.name][1] if prev else 0.0)
+            best[task.name] = (prev,total)
+        if not best:
+            return [], 0.0
+        name = max(best,key=lambda n : best[n][1])
+        total = best[name][1]
+        path, task = [], self.tasks[name]
+        while task is not None:
+            path.insert(0,task)
+            task = best[task.name][0]
+        return path, total
+
 # PATH UTILITIES
 
 def mkTmpPath(path,suffix="_tmp"):